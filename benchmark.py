@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from metronome import calculate_durations, encode_wav, render_trials
+from tug_stats import TugSummary
+from tug_store import MemorySheetBackend, TugStore, changed_rows
+from tug_video import get_video_frames
+
+# Synthetic videos as (width, height, frames); all are written at VIDEO_FPS
+VIDEO_CASES = [(320, 240, 90), (640, 480, 90), (640, 480, 300), (1280, 720, 150)]
+VIDEO_FPS = 30
+# Frames read in the random-access benchmark, like jumping around the slider
+RANDOM_ACCESS_FRAMES = 30
+# Click protocols as (trials, duration in seconds, subdivisions on/off). At
+# least two trials are needed, as calculate_durations spreads the speeds evenly.
+AUDIO_CASES = [(2, 10.0, False), (3, 10.0, False), (3, 10.0, True), (6, 30.0, False), (6, 30.0, True)]
+AUDIO_SECONDS = [1, 3, 7, 8, 12, 13, 15]
+AUDIO_SUBDIVISIONS = ["1 - 3", "8 - 12"]
+# Worksheet sizes, in rows, for the store benchmarks
+SHEET_ROWS = [10 ** 2, 10 ** 3, 10 ** 4, 10 ** 5]
+# Rows changed in the data editor before "Save Changes"
+EDITED_ROWS = 10
+# Runs per benchmark; the median is reported
+REPEAT = 5
+# Slowdown, as a fraction of the baseline median, reported as a regression
+REGRESSION_THRESHOLD = 0.25
+# Medians below this many seconds are too noisy to compare
+MIN_COMPARABLE_SECONDS = 0.001
+
+
+# Function to time `function` over `repeat` runs. `setup` runs untimed before
+# each run and its return value is passed to `function`.
+def measure(function, repeat=REPEAT, setup=None):
+    times = []
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        start = time.perf_counter()
+        function(state) if setup is not None else function()
+        times.append(time.perf_counter() - start)
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'repeat': repeat}
+
+
+# Function to write a synthetic test video: a bright block sweeping across a
+# noisy background, so the encoder and decoder do realistic work
+def make_video(path, width, height, frame_count, fps=VIDEO_FPS):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"could not open a video writer for {path}")
+    rng = np.random.default_rng(0)
+    block = max(8, height // 6)
+    for i in range(frame_count):
+        frame = rng.integers(0, 40, size=(height, width, 3), dtype=np.uint8)
+        x = (i * 7) % max(1, width - block)
+        frame[height // 3:height // 3 + block, x:x + block] = 255
+        writer.write(frame)
+    writer.release()
+
+
+def bench_video(directory, repeat, quick):
+    results = {}
+    for width, height, frame_count in VIDEO_CASES[:2] if quick else VIDEO_CASES:
+        path = os.path.join(directory, f"bench_{width}x{height}_{frame_count}.mp4")
+        make_video(path, width, height, frame_count)
+        label = f"{width}x{height},{frame_count}f"
+        indices = np.random.default_rng(1).integers(0, frame_count, RANDOM_ACCESS_FRAMES).tolist()
+
+        def open_video():
+            frames, _ = get_video_frames(path)
+            frames.release()
+
+        def read_all(frames):
+            for i in range(len(frames)):
+                frames[i]
+            frames.release()
+
+        def read_random(frames):
+            for i in indices:
+                frames[min(i, len(frames) - 1)]
+            frames.release()
+
+        results[f"video.open[{label}]"] = measure(open_video, repeat)
+        results[f"video.sequential[{label}]"] = measure(read_all, repeat, lambda: get_video_frames(path)[0])
+        results[f"video.random[{label}]"] = measure(read_random, repeat, lambda: get_video_frames(path)[0])
+    return results
+
+
+def bench_audio(repeat, quick):
+    results = {}
+    for trials, duration, subdivided in AUDIO_CASES[:3] if quick else AUDIO_CASES:
+        label = f"{trials}x{duration:g}s{',subdivided' if subdivided else ''}"
+        subdivisions = AUDIO_SUBDIVISIONS if subdivided else None
+
+        def synthesize():
+            return render_trials(AUDIO_SECONDS, calculate_durations(duration, trials), None, subdivided,
+                                 subdivisions, 4)[0]
+
+        audio = synthesize()
+        results[f"audio.synthesis[{label}]"] = measure(synthesize, repeat)
+        results[f"audio.encode[{label}]"] = measure(lambda: encode_wav(audio, 44100), repeat)
+    return results
+
+
+# Function to build a worksheet of `n` plausible TUG records
+def make_records(n, seed=0):
+    rng = np.random.default_rng(seed)
+    initial = rng.uniform(6, 30, n).round(2)
+    final = (initial - rng.uniform(-2, 6, n)).round(2)
+    return pd.DataFrame({
+        "SUBJECT'S NAME": [f"subject_{i}" for i in range(n)],
+        "SUBJECT'S AGE": rng.integers(40, 100, n),
+        "ICD": rng.choice(["Healthy", "Impairments", "Complaints", "Discomfort"], n),
+        "DATE": "2024-01-01",
+        "TUG-INITIAL": initial,
+        "TUG-FINAL": final,
+        "TUG-DIFFERENCE": (initial - final).round(2),
+    })
+
+
+# Benchmarks of the gs_db flows against TugStore over an in-memory backend
+def bench_sheets(directory, repeat, quick):
+    results = {}
+    for n in SHEET_ROWS[:3] if quick else SHEET_ROWS:
+        records = make_records(n)
+        path = os.path.join(directory, f"bench_{n}.sqlite")
+
+        def open_store():
+            if os.path.exists(path):
+                os.remove(path)
+            return TugStore(path, MemorySheetBackend(records), start=False, summary=TugSummary())
+
+        def load(store):
+            store.close()
+
+        # Page load: the first read of a store that was filled from the remote
+        def cold_read(store):
+            store.read()
+            store.close()
+
+        def submit(store):
+            store.append(make_records(1, seed=1))
+            store.flush()
+            store.read()
+            store.close()
+
+        def save(store):
+            snapshot = store.read()
+            edited = snapshot.copy()
+            rows = edited.index[::max(1, n // EDITED_ROWS)][:EDITED_ROWS]
+            edited.loc[rows, 'TUG-FINAL'] = edited.loc[rows, 'TUG-FINAL'] - 1
+            changed = changed_rows(snapshot, edited)
+            edited.loc[changed, 'TUG-DIFFERENCE'] = (edited.loc[changed, 'TUG-INITIAL']
+                                                     - edited.loc[changed, 'TUG-FINAL'])
+            store.update(edited.loc[changed])
+            store.flush()
+            store.close()
+
+        results[f"sheets.load[{n}]"] = measure(lambda: load(open_store()), repeat)
+        results[f"sheets.read[{n}]"] = measure(cold_read, repeat, open_store)
+        results[f"sheets.submit[{n}]"] = measure(submit, repeat, open_store)
+        results[f"sheets.save[{n}]"] = measure(save, repeat, open_store)
+        os.remove(path)
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'opencv': cv2.__version__,
+    }
+
+
+# Function to compare results with a baseline. Returns (name, baseline median,
+# current median, ratio) for every benchmark slower than the threshold allows.
+def regressions(baseline, results, threshold=REGRESSION_THRESHOLD):
+    slower = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None or max(before['median_s'], result['median_s']) < MIN_COMPARABLE_SECONDS:
+            continue
+        ratio = result['median_s'] / before['median_s']
+        if ratio > 1 + threshold:
+            slower.append((name, before['median_s'], result['median_s'], ratio))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the offline performance benchmarks.",
+        epilog="Record a baseline with --save baseline.json, then check later runs with --compare baseline.json; "
+               "the exit status is 1 when any benchmark regressed.")
+    parser.add_argument('--only', choices=['video', 'audio', 'sheets'], action='append',
+                        help="Run only these groups (repeatable; default: all)")
+    parser.add_argument('--quick', action='store_true', help="Skip the largest cases")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="Runs per benchmark")
+    parser.add_argument('--save', help="Write the results as a JSON baseline to this file")
+    parser.add_argument('--compare', help="Baseline JSON file to check the results against")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Allowed slowdown as a fraction of the baseline (default: %(default)s)")
+    args = parser.parse_args(argv)
+    groups = args.only or ['video', 'audio', 'sheets']
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="tug_bench_") as directory:
+        if 'video' in groups:
+            results.update(bench_video(directory, args.repeat, args.quick))
+        if 'audio' in groups:
+            results.update(bench_audio(args.repeat, args.quick))
+        if 'sheets' in groups:
+            results.update(bench_sheets(directory, args.repeat, args.quick))
+
+    for name, result in results.items():
+        print(f"{name:45s} {result['median_s'] * 1000:10.2f} ms  (min {result['min_s'] * 1000:.2f} ms)")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        slower = regressions(baseline, results, args.threshold)
+        for name, before, after, ratio in slower:
+            print(f"REGRESSION {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({ratio:.2f}x)",
+                  file=sys.stderr)
+        missing = sorted(set(baseline) - set(results))
+        if missing and not args.only and not args.quick:
+            print(f"Not run, but in the baseline: {', '.join(missing)}", file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
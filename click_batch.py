@@ -0,0 +1,116 @@
+import argparse
+import csv
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from metronome import OUTPUT_PROFILES, stream_wav, write_zip
+
+DEFAULT_PROFILE = next(iter(OUTPUT_PROFILES))
+
+
+# Function to turn one CSV row into render arguments. Expected columns:
+#   subject        output name, e.g. subject_01
+#   seconds        space-separated click times, e.g. "1 3 7 8 12 13 15"
+#   trials         number of motor imagery trials
+#   duration       output duration in seconds (defaults to the last second + 1)
+#   subdivisions   optional ";"-separated pairs, e.g. "1 - 3; 8 - 12"
+#   numb_subdivisions  optional number of subdivisions per pair (default 4)
+def parse_subject(row):
+    seconds = [float(second) for second in row['seconds'].split()]
+    duration = float(row['duration']) if row.get('duration') else seconds[-1] + 1.00
+    pairs = [pair.split('-') for pair in (row.get('subdivisions') or '').split(';') if pair.strip()]
+    subdivisions = [f"{int(start)} - {int(end)}" for start, end in pairs]
+    numb_subdivisions = int(row['numb_subdivisions']) if row.get('numb_subdivisions') else 4
+    return {
+        'subject': row['subject'],
+        'seconds': seconds,
+        'number_of_trials': int(row['trials']),
+        'duration': duration,
+        'enable_subdivisions': bool(subdivisions),
+        'subdivisions': subdivisions,
+        'numb_subdivisions': numb_subdivisions,
+    }
+
+
+# Function to build an output file name without the brackets and spaces of the
+# list repr used for the web app's downloads, e.g. "s01_baseline_1-3-7"
+def batch_file_name(name, seconds, suffix=''):
+    safe_name = re.sub(r'[^\w.-]+', '_', name).strip('_') or 'subject'
+    return f"{safe_name}{suffix}_{'-'.join(f'{second:g}' for second in seconds)}"
+
+
+# Function to render one subject and write its files. Runs in a worker process
+# so only the written paths travel back, never the audio.
+def render_subject(subject, output_dir, profile=DEFAULT_PROFILE, bundle=False):
+    sample_rate, dtype = OUTPUT_PROFILES[profile]
+    name, seconds = subject['subject'], subject['seconds']
+    paths = []
+    try:
+        # Both files are streamed to disk chunk by chunk, so long protocols
+        # are never held in memory in full; the baseline is the first trial
+        arguments = (seconds, subject['number_of_trials'], subject['duration'], subject['enable_subdivisions'],
+                     subject['subdivisions'], subject['numb_subdivisions'], sample_rate, dtype)
+        streams = [(batch_file_name(name, seconds) + '.wav', stream_wav(*arguments)),
+                   (batch_file_name(name, seconds, '_baseline') + '.wav', stream_wav(*arguments, trials=[0]))]
+
+        if bundle:
+            paths.append(os.path.join(output_dir, batch_file_name(name, seconds) + '.zip'))
+            write_zip(paths[-1], streams)
+        else:
+            for file_name, chunks in streams:
+                paths.append(os.path.join(output_dir, file_name))
+                with open(paths[-1], 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+        return name, paths, None
+    except Exception as e:
+        # Do not leave half-written files behind
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+        return name, [], str(e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render Sync-TUG metronome protocols for a cohort of subjects.")
+    parser.add_argument('subjects', help="CSV with subject, seconds, trials, duration, subdivisions and "
+                                         "numb_subdivisions columns")
+    parser.add_argument('--output-dir', default='.', help="Directory the audio files are written to")
+    parser.add_argument('--profile', choices=list(OUTPUT_PROFILES), default=DEFAULT_PROFILE)
+    parser.add_argument('--zip', action='store_true', help="Write one deflated ZIP per subject")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    # A malformed row is reported like a failed render, without stopping the
+    # rest of the cohort; line numbers count the header as line 1
+    failures = 0
+    subjects = []
+    with open(args.subjects, newline='') as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            try:
+                subjects.append(parse_subject(row))
+            except Exception as e:
+                failures += 1
+                error = f"missing column {e}" if isinstance(e, KeyError) else str(e)
+                print(f"{row.get('subject') or '?'}: invalid row on line {line} ({error})", file=sys.stderr)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(render_subject, subject, args.output_dir, args.profile, args.zip)
+                   for subject in subjects]
+        # Report each subject as soon as its files are written
+        for future in as_completed(futures):
+            name, paths, error = future.result()
+            if error:
+                failures += 1
+                print(f"{name}: failed ({error})", file=sys.stderr)
+            else:
+                print(f"{name}: {', '.join(paths)}")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
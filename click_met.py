@@ -2,113 +2,78 @@ import streamlit as st
 import numpy as np
 import time
 import threading
-import wave
-import io
+from collections import OrderedDict
 
-scaled_seconds = []
-
-
-def generate_tone(duration_ms, sample_rate=44100, frequency=440.0):
-    t = np.linspace(0, duration_ms / 1000, int(duration_ms * sample_rate / 1000), endpoint=False)
-    tone = np.sin(2 * np.pi * frequency * t)
-    return tone
-
-
-def calculate_durations(output_duration, number_of_trials):
-    final_trial_duration = output_duration / 2
-    incremental_metronome_value = (output_duration - final_trial_duration) / (number_of_trials - 1)
-    
-    output_duration_list = [round(output_duration - i * incremental_metronome_value, 2) for i in range(number_of_trials)]
-    return output_duration_list
-
-
-def process_subdivisions(all_pairs, scaling_factor, sample_rate, num_subdivisions, total_samples):
-    duration_ms = 100
-    frequency_for_subdivisions = 300.0
-    tone_for_subdivisions = generate_tone(duration_ms, sample_rate, frequency_for_subdivisions)
-    
-    audio_data = np.zeros(total_samples)
-    
-    for pair in all_pairs:
-        start_sample_event = int(pair[0] * sample_rate * scaling_factor)
-        second_duration = pair[1] - pair[0]
-        spacing_samples = int(second_duration * sample_rate * scaling_factor)
-        spacing_samples_per_click = spacing_samples // (num_subdivisions + 1)
-        
-        for i in range(1, num_subdivisions + 1):
-            click_start_sample = start_sample_event + i * spacing_samples_per_click
-            audio_data[click_start_sample:click_start_sample + len(tone_for_subdivisions)] += tone_for_subdivisions
-
-    return audio_data
-
-
-def process_file(seconds, duration, filename, enable_subdivisions, subdivisions, numb_subdivisions):
-    last_second = seconds[-1]
-    input_duration = last_second + 1
-    scaling_factor = duration / input_duration
-    sample_rate = 44100
-    total_samples = int(duration * sample_rate)
-    special_frequency = 660.0    
-    # tone = generate_tone(100, sample_rate, 440.0)
-    
-    audio_data = np.zeros(total_samples)
-    beep_count = 0
-
-    for timestamp in seconds:
-        beep_count += 1
-        if beep_count == 1 or beep_count == 6:
-            tone = generate_tone(300, sample_rate, special_frequency)
-        else:
-            tone = generate_tone(100, sample_rate, 440.0)
+import perf
+from metronome import OUTPUT_PROFILES, SAMPLE_RATE, render_protocol, render_trial, wav_file_name, zip_bundle
 
-        start_sample = int(timestamp * sample_rate * scaling_factor)
-        audio_data[start_sample:start_sample + len(tone)] += tone
-    
-    if enable_subdivisions:
-        
-        all_pairs = sorted([tuple(map(int, second.split(' - '))) for second in subdivisions])
-        audio_data += process_subdivisions(all_pairs, scaling_factor, sample_rate, numb_subdivisions, total_samples)
-    
-    audio_data /= np.max(np.abs(audio_data))
-    
-    return audio_data, sample_rate
+scaled_seconds = []
 
+# Encoded audio kept by the render cache, shared by all sessions
+RENDER_CACHE_BYTES = 256 * 1024 ** 2
 
-def write_to_wav_file(audio_data, filename, sample_rate, seconds):
-    
-    audio_data_pcm = (audio_data * 32767).astype(np.int16)
 
-    filename_wav = filename + '.wav'
+def write_to_wav_file(wav_bytes, filename, seconds):
 
+    # Streamlit's download button serves the encoded bytes directly
     if 'baseline' in filename:
-        with wave.open(filename_wav, 'wb') as wav_file:
-                wav_file.setnchannels(1)
-                wav_file.setsampwidth(2)
-                wav_file.setframerate(sample_rate)
-                wav_file.writeframes(audio_data_pcm.tobytes())
-            
-                with open(filename_wav, 'rb') as f:
-                # Streamlit's download button will now serve the file directly
-                    st.download_button(
-                        label=f"Download Baseline {seconds}",  # Hidden to user
-                        data=f,
-                        file_name=f"Baseline_{filename}_{seconds}.wav",
-                        mime="audio/wav")    
+        st.download_button(
+            label=f"Download Baseline {seconds}",  # Hidden to user
+            data=wav_bytes,
+            file_name=wav_file_name(filename, seconds),
+            mime="audio/wav")
 
     else:
-        with wave.open(filename_wav, 'wb') as wav_file:
-            wav_file.setnchannels(1)
-            wav_file.setsampwidth(2)
-            wav_file.setframerate(sample_rate)
-            wav_file.writeframes(audio_data_pcm.tobytes())
-        
-            with open(filename_wav, 'rb') as f:
-            # Streamlit's download button will now serve the file directly
-                st.download_button(
-                    label=f"Download {seconds}",  # Hidden to user
-                    data=f,
-                    file_name=f"{filename}_{seconds}.wav",
-                    mime="audio/wav")
+        st.download_button(
+            label=f"Download {seconds}",  # Hidden to user
+            data=wav_bytes,
+            file_name=wav_file_name(filename, seconds),
+            mime="audio/wav")
+
+
+# Cache of encoded renders keyed by the normalised render parameters, shared
+# by all sessions. Least recently used renders are evicted past the byte cap.
+class RenderCache:
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (full WAV bytes, baseline WAV bytes)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                perf.count('render_cache_misses')
+                return None
+            self.entries.move_to_end(key)
+            perf.count('render_cache_hits')
+            return self.entries[key]
+
+    def put(self, key, rendered):
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= sum(len(data) for data in self.entries.pop(key))
+            self.entries[key] = rendered
+            self.total_bytes += sum(len(data) for data in rendered)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= sum(len(data) for data in evicted)
+
+
+@st.cache_resource
+def get_render_cache():
+    return RenderCache()
+
+
+# Function to build the render cache key. Only inputs that change the audio are
+# included, so e.g. renaming the output reuses the cached render.
+def render_key(seconds, number_of_trials, duration, enable_subdivisions, subdivisions, numb_subdivisions,
+               sample_rate=SAMPLE_RATE, dtype=np.float64):
+    pairs = ()
+    if enable_subdivisions and subdivisions and numb_subdivisions:
+        pairs = tuple(sorted(tuple(map(int, second.split(' - '))) for second in subdivisions))
+    return (tuple(float(second) for second in seconds), int(number_of_trials), round(float(duration), 6),
+            pairs, int(numb_subdivisions) if pairs else 0, sample_rate, np.dtype(dtype).name)
 
 
 def main():
@@ -185,6 +150,10 @@ def main():
             
         subdivisions = st.multiselect(label="Subdivisions between: ", options=formatted_seconds)
         numb_subdivisions = st.slider("Number of Subdivisions", min_value=0, max_value=8, value=4, step=1)
+
+    profile = st.selectbox("Output Profile", options=list(OUTPUT_PROFILES),
+                           help="Lower sample rates give much smaller files with the same clicks")
+    bundle = st.checkbox("Download as compressed ZIP")
            
     st.markdown(
     """
@@ -208,32 +177,44 @@ def main():
     # if st.button("DOWNLOAD"):
 
     try:
-        list_of_durations = calculate_durations(duration, number_of_trials)
-
-        concatenated_audio = np.array([])
-        final_sample_rate = None
-        SLEEP_DURATION = 10
-        
+        sample_rate, dtype = OUTPUT_PROFILES[profile]
+
+        # A single trial is synthesised on its own, so a timing change can be
+        # heard straight away without rendering the whole protocol
+        preview_trial = st.number_input("Preview Trial", min_value=1, max_value=int(number_of_trials), step=1,
+                                        value=1, help="Trial 1 is the baseline")
+        if st.button("Preview"):
+            st.audio(render_trial(seconds, number_of_trials, duration, int(preview_trial) - 1, enable_subdivisions,
+                                  subdivisions, numb_subdivisions, sample_rate, dtype), format="audio/wav")
+
+        key = render_key(seconds, number_of_trials, duration, enable_subdivisions, subdivisions, numb_subdivisions,
+                         sample_rate, dtype)
+        rendered = get_render_cache().get(key)
+
+        if rendered is None:
+            rendered = render_protocol(seconds, number_of_trials, duration, enable_subdivisions, subdivisions,
+                                       numb_subdivisions, sample_rate, dtype)
+            get_render_cache().put(key, rendered)
+
+        if bundle:
+            # The ZIP embeds the file names, so it is cached per name as well
+            names = (wav_file_name(filename, seconds), wav_file_name(filename + "_baseline", seconds))
+            bundled = get_render_cache().get((key, names))
+            if bundled is None:
+                bundled = (zip_bundle(zip(names, rendered)),)
+                get_render_cache().put((key, names), bundled)
+
+            st.download_button(
+                label=f"Download ZIP {seconds}",
+                data=bundled[0],
+                file_name=f"{filename}_{seconds}.zip",
+                mime="application/zip")
 
-        for i in range(len(list_of_durations)):
-            # filename += f'{i+1}'
-            audio_data, sample_rate = process_file(seconds, list_of_durations[i], filename, enable_subdivisions, subdivisions, numb_subdivisions)
-            concatenated_audio = np.concatenate((concatenated_audio, audio_data)) if concatenated_audio.size else audio_data
-            final_sample_rate = sample_rate
-            if i < len(list_of_durations) - 1:
-                silent_gap = np.zeros(int(SLEEP_DURATION * final_sample_rate))
-                concatenated_audio = np.concatenate((concatenated_audio, silent_gap))
-
-        write_to_wav_file(concatenated_audio, filename, sample_rate, seconds)
-            # write_to_wav_file(audio_data, filename, sample_rate)
-
-        baseline_part = int(duration * final_sample_rate)
-
-        # Slice the concatenated audio to retain only the first part
-        baseline_part_audio = concatenated_audio[:baseline_part]
+        else:
+            write_to_wav_file(rendered[0], filename, seconds)
 
-        # Write only the first part to the WAV file
-        write_to_wav_file(baseline_part_audio, filename + "_baseline", final_sample_rate, seconds)
+            # Only the first trial goes into the baseline file
+            write_to_wav_file(rendered[1], filename + "_baseline", seconds)
 
 
 
@@ -243,6 +224,7 @@ def main():
         
         
     st.write('#') 
+    perf.debug_panel()
 
 if __name__ == "__main__":
     main()
@@ -1,17 +1,130 @@
 import streamlit as st
 from streamlit_gsheets import GSheetsConnection
+import gspread
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+import copy
+import os
+from io import BytesIO
+import perf
+from tug_stats import AGE_BINS, IMPROVEMENT_THRESHOLD, SCORE_BINS, SCORE_COLUMNS, TugSummary
+from tug_store import GSheetsBackend, TugStore, changed_rows
+
+# Default directory of the local store. It holds subject records and unsynced
+# changes, so it lives in a per-user data directory rather than the working
+# directory; the "local_store_path" secret overrides it.
+STORE_DIR = os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "tug")
+
+
+# Function to open the connection's spreadsheet with our own gspread client,
+# built from the same service-account secrets, for row-level writes. Returns
+# None for public or misconfigured connections; the store then falls back to
+# replacing the whole worksheet through the connection.
+def open_spreadsheet():
+    secrets = dict(st.secrets.get("connections", {}).get("gsheets", {}))
+    if secrets.get("type") != "service_account":
+        return None
+    try:
+        spreadsheet = secrets.pop("spreadsheet")
+        secrets.pop("worksheet", None)
+        client = gspread.service_account_from_dict(secrets)
+        if spreadsheet.startswith("https://"):
+            return client.open_by_url(spreadsheet)
+        return client.open_by_key(spreadsheet)
+    except Exception as e:
+        st.warning(f"Saving through full worksheet updates: could not open the spreadsheet ({e})")
+        return None
+
+
+# Process-wide local store of the worksheet, synced to Google Sheets in the
+# background so page interactions never wait on the Sheets API
+@st.cache_resource
+def get_tug_store(_conn, worksheet):
+    path = st.secrets.get("local_store_path") or os.path.join(STORE_DIR, "tug_records.sqlite")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    backend = GSheetsBackend(_conn, worksheet, open_spreadsheet())
+    return TugStore(path, backend, ttl=float(st.secrets.get("sheet_cache_ttl", 300)),
+                    summary=TugSummary())
+
+
+# Function to render a figure to PNG bytes and free it
+def figure_png(fig):
+    import matplotlib.pyplot as plt
+
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+# Function to draw the plots from the store's running summary. Every chart is
+# drawn from fixed bins and counts, so the cost does not grow with the number
+# of subjects, and the images are reused until the data version changes.
+@st.cache_data(max_entries=4)
+@perf.timed('plots.render')
+def render_plots(version, _summary):
+    # The plotting libraries are only loaded once plots are requested, as
+    # most sessions just submit or edit records
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    fig, ax = plt.subplots(1, 2, figsize=(12, 6))
+
+    # Plot 1: Age Distribution
+    ax[0].bar(AGE_BINS[:-1], _summary.age_counts, width=AGE_BINS[1] - AGE_BINS[0], align='edge',
+              color=sns.color_palette()[0], edgecolor='white')
+    ax[0].set_title("Age Distribution")
+    ax[0].set_xlabel("Age")
+    ax[0].set_ylabel("Frequency")
+
+    # Plot 2: distributions of TUG-INITIAL and TUG-FINAL with their means
+    for column, color in zip(SCORE_COLUMNS, ['cyan', 'purple']):
+        count, mean, std = _summary.score_stats(column)
+        ax[1].stairs(_summary.score_counts[column], SCORE_BINS, fill=True, alpha=0.5, color=color,
+                     label=f"{column} (mean {mean:.2f} ± {std:.2f} s)" if count else column)
+        if count:
+            ax[1].axvline(mean, color=color, linestyle='--')
+    ax[1].set_title("TUG Scores Comparison")
+    ax[1].set_xlabel("Scores")
+    ax[1].set_ylabel("Subjects")
+    ax[1].legend()
+
+    figg, ax = plt.subplots(1, 2, figsize=(12, 6))
+    labels = ['COI', ' ']
+    sizes = [_summary.improved, _summary.not_improved]
+    if sum(sizes):
+        ax[0].pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90, colors=['lightpink', 'purple'])
+    ax[0].axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
+    ax[0].set_title(f'Proportion of Subjects with TUG Difference ≥ {IMPROVEMENT_THRESHOLD}')
+
+    # Count of each ICD label among subjects below the threshold
+    icd_counts = _summary.icd_counts.most_common()
+    palette = sns.color_palette("pastel", len(icd_counts))
+    ax[1].bar([str(label) for label, _ in icd_counts], [count for _, count in icd_counts], color=palette)
+    ax[1].set_xlabel("ICD Category")
+    ax[1].set_ylabel("Frequency")
+    ax[1].set_title(f"Frequency of ICD Labels for Subjects with TUG Difference < {IMPROVEMENT_THRESHOLD}")
+
+    return [figure_png(fig), figure_png(figg)]
+
 
 # Establishing a Google Sheets connection
 
 st.title("TUG Management Portal")
 spreadsheet = st.secrets["connections_gsheets"]["spreadsheet"]
 conn = st.connection("gsheets", type=GSheetsConnection)
-# Fetch existing data
-existing_data = conn.read(worksheet='TUG_SCORE')
-existing_data = existing_data.dropna(how="all")
+# Fetch existing data from the local store, reloading it from Google Sheets on request
+store = get_tug_store(conn, 'TUG_SCORE')
+if st.button('Refresh Data'):
+    try:
+        store.refresh()
+    except Exception as e:
+        st.warning(f"Could not refresh from Google Sheets: {e}")
+existing_data = store.read()
+
+if store.pending():
+    st.caption(f"{store.pending()} change(s) waiting to sync to Google Sheets.")
+if store.last_error is not None:
+    st.warning(f"Google Sheets is unavailable, changes are kept locally and will be retried: {store.last_error}")
 
 
 ICD = [
@@ -60,12 +173,11 @@ with st.form(key="TUG_form"):
                 ]
             )
 
-            # Add the new vendor data to the existing data
-            existing_data = pd.concat([existing_data, subject_data], ignore_index=True)
+            # Store the new row locally; only the row itself is appended to Google Sheets
+            store.append(subject_data)
 
-
-            # Update Google Sheets with the new vendor data
-            conn.update(worksheet="TUG_SCORE", data=existing_data)
+            # Add the new vendor data to the existing data
+            existing_data = store.read()
 
             st.toast("Details successfully submitted!")
             st.info("Details successfully submitted!")
@@ -74,60 +186,26 @@ with st.form(key="TUG_form"):
 
 updated_data = st.data_editor(existing_data)
 if st.button('Save Changes'):
-    # conn.update(worksheet="TUG_SCORE", data=updated_data)
-    updated_data["TUG-DIFFERENCE"] = updated_data['TUG-INITIAL'] - updated_data['TUG-FINAL']
+    # Only rows edited since the last sync are recomputed and sent
+    changed = changed_rows(existing_data, updated_data)
+    if changed is None:
+        updated_data["TUG-DIFFERENCE"] = updated_data['TUG-INITIAL'] - updated_data['TUG-FINAL']
+        store.replace(updated_data)
+    elif len(changed):
+        updated_data.loc[changed, "TUG-DIFFERENCE"] = (updated_data.loc[changed, 'TUG-INITIAL']
+                                                       - updated_data.loc[changed, 'TUG-FINAL'])
+        store.update(updated_data.loc[changed])
     st.info('Observe the updates below')
-    conn.update(worksheet="TUG_SCORE", data=updated_data)
     st.dataframe(updated_data)
     st.info('Changes saved successfully!')
 
 
 if st.button('Generate Plots'):
-    # Create plots based on the data
-    fig, ax = plt.subplots(1, 2, figsize=(12, 6))
-
-    # Example Plot 1: Age Distribution
-    sns.lineplot(updated_data['SUBJECT\'S AGE'], ax=ax[0])
-    ax[0].set_title("Age Distribution")
-    ax[0].set_xlabel("Age")
-    ax[0].set_ylabel("Frequency")
-
-    # Bar width
-    bar_width = 0.35
-    subjects = updated_data.index
-
-    # Create bars for TUG-INITIAL and TUG-FINAL
-    ax[1].bar(subjects, updated_data['TUG-INITIAL'], width=bar_width, label='TUG-INITIAL', color='cyan', align='center')
-    ax[1].bar(subjects, updated_data['TUG-FINAL'], width=bar_width, label='TUG-FINAL', color='purple', align='edge')
-
-    # Adding labels and title
-    ax[1].set_title("TUG Scores Comparison")
-    ax[1].set_xlabel("Subjects")
-    ax[1].set_ylabel("Scores")
-    ax[1].legend()
-    ax[1].set_xticklabels(subjects, rotation=45, ha='right')  # Rotate subject names for better readability
-
-    st.pyplot(fig)
-
-    figg, ax = plt.subplots(1,2,figsize=(12, 6))
-    count_greater_equal_2 = (existing_data['TUG-DIFFERENCE'] >= 2).sum()
-    count_less_than_2 = (existing_data['TUG-DIFFERENCE'] < 2).sum()
-    labels = ['COI', ' ']
-    sizes = [count_greater_equal_2, count_less_than_2]
-    ax[0].pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90, colors=['lightpink', 'purple'])
-    ax[0].axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-    ax[0].set_title('Proportion of Subjects with TUG Difference ≥ 2')
-
-    filtered_data = existing_data[existing_data['TUG-DIFFERENCE'] < 2]
-
-    # Count the occurrences of each ICD label for these subjects
-    icd_counts = filtered_data['ICD'].value_counts()
-    palette = sns.color_palette("pastel", len(icd_counts))
-
-    # Plotting
-    ax[1].bar(icd_counts.index, icd_counts.values, color=palette)
-    ax[1].set_xlabel("ICD Category")
-    ax[1].set_ylabel("Frequency")
-    ax[1].set_title("Frequency of ICD Labels for Subjects with TUG Difference < 2")
-
-    st.pyplot(figg)
+    # Create plots from the precomputed summaries of the stored data; the
+    # summary is copied so a background sync cannot change it mid-render
+    with store.lock:
+        version, summary = store.version, copy.deepcopy(store.summary)
+    for image in render_plots(version, summary):
+        st.image(image)
+
+perf.debug_panel()
@@ -0,0 +1,260 @@
+import io
+import itertools
+import struct
+import zipfile
+from functools import lru_cache
+
+import numpy as np
+
+import perf
+
+SAMPLE_RATE = 44100
+# Silent gap between trials, in seconds
+SLEEP_DURATION = 10
+# Samples converted to 16-bit PCM at a time while encoding
+WAV_CHUNK_SAMPLES = 65536
+WAV_SAMPLE_WIDTH = 2
+
+# Output profiles as (sample rate, synthesis dtype). The highest tone is 660 Hz,
+# far below the Nyquist frequency of even the 8 kHz profile.
+OUTPUT_PROFILES = {
+    "Standard (44.1 kHz)": (44100, np.float64),
+    "Compact (16 kHz)": (16000, np.float32),
+    "Minimal (8 kHz)": (8000, np.float32),
+}
+
+
+# Tones are memoised per (duration_ms, sample_rate, frequency, dtype); the
+# returned arrays are shared, so they are marked read-only
+@lru_cache(maxsize=32)
+def generate_tone(duration_ms, sample_rate=44100, frequency=440.0, dtype=np.float64):
+    t = np.linspace(0, duration_ms / 1000, int(duration_ms * sample_rate / 1000), endpoint=False)
+    tone = np.sin(2 * np.pi * frequency * t).astype(dtype, copy=False)
+    tone.flags.writeable = False
+    return tone
+
+
+# Function to mix one tone into the buffer at every start offset at once.
+# Overlapping clicks add up and clicks running past the end are clipped.
+def add_clicks(audio_data, start_samples, tone):
+    start_samples = np.asarray(start_samples, dtype=np.int64)
+    if start_samples.size == 0:
+        return audio_data
+    indices = start_samples[:, None] + np.arange(len(tone))
+    inside = (indices >= 0) & (indices < len(audio_data))
+    indices, values = indices[inside], np.broadcast_to(tone, indices.shape)[inside]
+    if np.all(np.diff(np.sort(start_samples)) >= len(tone)):
+        audio_data[indices] += values  # No index repeats, so buffered fancy indexing is exact
+    else:
+        np.add.at(audio_data, indices, values)
+    return audio_data
+
+
+def calculate_durations(output_duration, number_of_trials):
+    final_trial_duration = output_duration / 2
+    incremental_metronome_value = (output_duration - final_trial_duration) / (number_of_trials - 1)
+    
+    output_duration_list = [round(output_duration - i * incremental_metronome_value, 2) for i in range(number_of_trials)]
+    return output_duration_list
+
+
+def process_subdivisions(all_pairs, scaling_factor, sample_rate, num_subdivisions, total_samples, out=None,
+                         dtype=np.float64):
+    # Clicks are mixed into `out` in place when a buffer is given
+    audio_data = np.zeros(total_samples, dtype=dtype) if out is None else out
+
+    duration_ms = 100
+    frequency_for_subdivisions = 300.0
+    tone_for_subdivisions = generate_tone(duration_ms, sample_rate, frequency_for_subdivisions, audio_data.dtype)
+    
+    if len(all_pairs) and num_subdivisions:
+        pairs = np.asarray(all_pairs, dtype=np.float64)
+        start_sample_event = (pairs[:, 0] * sample_rate * scaling_factor).astype(np.int64)
+        second_duration = pairs[:, 1] - pairs[:, 0]
+        spacing_samples = (second_duration * sample_rate * scaling_factor).astype(np.int64)
+        spacing_samples_per_click = spacing_samples // (num_subdivisions + 1)
+
+        # One row of click offsets per pair, subdivisions 1..num_subdivisions
+        click_start_samples = start_sample_event[:, None] + np.arange(1, num_subdivisions + 1) * spacing_samples_per_click[:, None]
+        add_clicks(audio_data, click_start_samples.ravel(), tone_for_subdivisions)
+
+    return audio_data
+
+
+def process_file(seconds, duration, filename, enable_subdivisions, subdivisions, numb_subdivisions, out=None,
+                 sample_rate=SAMPLE_RATE, dtype=np.float64):
+    last_second = seconds[-1]
+    input_duration = last_second + 1
+    scaling_factor = duration / input_duration
+    total_samples = trial_samples(duration, sample_rate)
+    special_frequency = 660.0    
+    # tone = generate_tone(100, sample_rate, 440.0)
+    
+    # Render into the caller's buffer when given one, otherwise a fresh trial buffer
+    audio_data = np.zeros(total_samples, dtype=dtype) if out is None else out[:total_samples]
+
+    # The 1st and 6th beeps use the longer, higher special tone
+    start_samples = (np.asarray(seconds, dtype=np.float64) * sample_rate * scaling_factor).astype(np.int64)
+    special = np.zeros(len(start_samples), dtype=bool)
+    special[[i for i in (0, 5) if i < len(special)]] = True
+    add_clicks(audio_data, start_samples[special], generate_tone(300, sample_rate, special_frequency, audio_data.dtype))
+    add_clicks(audio_data, start_samples[~special], generate_tone(100, sample_rate, 440.0, audio_data.dtype))
+    
+    if enable_subdivisions:
+        
+        all_pairs = sorted([tuple(map(int, second.split(' - '))) for second in subdivisions])
+        process_subdivisions(all_pairs, scaling_factor, sample_rate, numb_subdivisions, total_samples, out=audio_data)
+    
+    audio_data /= np.max(np.abs(audio_data))
+    perf.count('samples_rendered', total_samples)
+    
+    return audio_data, sample_rate
+
+
+def trial_samples(duration, sample_rate=SAMPLE_RATE):
+    return int(duration * sample_rate)
+
+
+# Function to render every trial, separated by silent gaps, into one buffer
+# allocated up front. Each trial is written in place at its offset.
+@perf.timed('audio.synthesis')
+def render_trials(seconds, list_of_durations, filename, enable_subdivisions, subdivisions, numb_subdivisions,
+                  sample_rate=SAMPLE_RATE, dtype=np.float64):
+    gap_samples = int(SLEEP_DURATION * sample_rate)
+    total_samples = sum(trial_samples(d, sample_rate) for d in list_of_durations) \
+        + gap_samples * (len(list_of_durations) - 1)
+    concatenated_audio = np.zeros(total_samples, dtype=dtype)
+
+    offset = 0
+    for trial_duration in list_of_durations:
+        process_file(seconds, trial_duration, filename, enable_subdivisions, subdivisions, numb_subdivisions,
+                     out=concatenated_audio[offset:], sample_rate=sample_rate)
+        offset += trial_samples(trial_duration, sample_rate) + gap_samples
+
+    return concatenated_audio, sample_rate
+
+
+# Function to build the 44-byte header of a mono 16-bit PCM WAV file
+def wav_header(n_frames, sample_rate):
+    data_size = n_frames * WAV_SAMPLE_WIDTH
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, 1, 1, sample_rate, sample_rate * WAV_SAMPLE_WIDTH, WAV_SAMPLE_WIDTH,
+                       8 * WAV_SAMPLE_WIDTH, b'data', data_size)
+
+
+# Function to encode audio as WAV bytes in memory. The float samples are
+# converted to 16-bit PCM one chunk at a time, so no full-length int16 copy
+# of the render is ever held alongside it.
+@perf.timed('audio.encode')
+def encode_wav(audio_data, sample_rate, chunk_samples=WAV_CHUNK_SAMPLES):
+    buffer = io.BytesIO()
+    buffer.write(wav_header(len(audio_data), sample_rate))
+
+    for start in range(0, len(audio_data), chunk_samples):
+        audio_data_pcm = (audio_data[start:start + chunk_samples] * 32767).astype('<i2')
+        buffer.write(audio_data_pcm)
+
+    perf.count('wav_bytes_encoded', buffer.tell())
+    return buffer.getvalue()
+
+
+# Function to cut the first `n_frames` out of an encoded WAV. The PCM data is
+# sliced from the existing encoding rather than converted again.
+def slice_wav(wav_bytes, n_frames, sample_rate):
+    header_size = len(wav_header(0, sample_rate))
+    n_frames = min(n_frames, (len(wav_bytes) - header_size) // WAV_SAMPLE_WIDTH)
+    pcm = memoryview(wav_bytes)[header_size:header_size + n_frames * WAV_SAMPLE_WIDTH]
+    return b''.join((wav_header(n_frames, sample_rate), pcm))
+
+
+# Function to render a full protocol and encode it. Returns the WAV bytes of
+# all trials and of the baseline (the first trial only).
+def render_protocol(seconds, number_of_trials, duration, enable_subdivisions=False, subdivisions=None,
+                    numb_subdivisions=None, sample_rate=SAMPLE_RATE, dtype=np.float64):
+    list_of_durations = calculate_durations(duration, number_of_trials)
+
+    concatenated_audio, sample_rate = render_trials(seconds, list_of_durations, None, enable_subdivisions,
+                                                    subdivisions, numb_subdivisions, sample_rate, dtype)
+
+    # The baseline is the first part of the same encoding, not a second encode
+    wav_bytes = encode_wav(concatenated_audio, sample_rate)
+    return wav_bytes, slice_wav(wav_bytes, int(duration * sample_rate), sample_rate)
+
+
+# Function to yield the samples of a protocol chunk by chunk. Trials are
+# synthesised one at a time into a buffer sized for the longest trial and the
+# silent gaps come from a shared block of zeros, so memory does not grow with
+# the number of trials. The chunks are views of that buffer and are only valid
+# until the next one is requested.
+def stream_trials(seconds, list_of_durations, enable_subdivisions, subdivisions, numb_subdivisions,
+                  sample_rate=SAMPLE_RATE, dtype=np.float64, chunk_samples=WAV_CHUNK_SAMPLES):
+    gap_samples = int(SLEEP_DURATION * sample_rate)
+    buffer = np.zeros(max(trial_samples(d, sample_rate) for d in list_of_durations), dtype=dtype)
+    silence = np.zeros(chunk_samples, dtype=dtype)
+    silence.flags.writeable = False
+
+    for n, trial_duration in enumerate(list_of_durations):
+        if n:
+            for start in range(0, gap_samples, chunk_samples):
+                yield silence[:min(chunk_samples, gap_samples - start)]
+
+        total_samples = trial_samples(trial_duration, sample_rate)
+        buffer[:total_samples] = 0
+        audio_data, _ = process_file(seconds, trial_duration, None, enable_subdivisions, subdivisions,
+                                     numb_subdivisions, out=buffer, sample_rate=sample_rate)
+        for start in range(0, total_samples, chunk_samples):
+            yield audio_data[start:start + chunk_samples]
+
+
+# Function to stream a protocol as WAV bytes: returns an iterator over the
+# header, then 16-bit PCM one chunk at a time. The bytes are the same as
+# encoding the full render. `trials` picks trial numbers (from 0) out of the
+# schedule, e.g. [0] for the baseline; gaps then only separate those trials.
+# The schedule is worked out before returning, so bad input fails here rather
+# than halfway through writing a file.
+def stream_wav(seconds, number_of_trials, duration, enable_subdivisions=False, subdivisions=None,
+               numb_subdivisions=None, sample_rate=SAMPLE_RATE, dtype=np.float64, trials=None):
+    list_of_durations = calculate_durations(duration, number_of_trials)
+    if trials is not None:
+        list_of_durations = [list_of_durations[n] for n in trials]
+
+    n_frames = sum(trial_samples(d, sample_rate) for d in list_of_durations) \
+        + int(SLEEP_DURATION * sample_rate) * (len(list_of_durations) - 1)
+    pcm = ((chunk * 32767).astype('<i2').tobytes()
+           for chunk in stream_trials(seconds, list_of_durations, enable_subdivisions, subdivisions,
+                                      numb_subdivisions, sample_rate, dtype))
+    return itertools.chain([wav_header(n_frames, sample_rate)], pcm)
+
+
+# Function to render a single trial of a protocol as WAV bytes, for previewing
+# a timing change without rendering the whole protocol
+def render_trial(seconds, number_of_trials, duration, trial, enable_subdivisions=False, subdivisions=None,
+                 numb_subdivisions=None, sample_rate=SAMPLE_RATE, dtype=np.float64):
+    return b''.join(stream_wav(seconds, number_of_trials, duration, enable_subdivisions, subdivisions,
+                               numb_subdivisions, sample_rate, dtype, trials=[trial]))
+
+
+def wav_file_name(filename, seconds):
+    if 'baseline' in filename:
+        return f"Baseline_{filename}_{seconds}.wav"
+    return f"{filename}_{seconds}.wav"
+
+
+# Function to bundle the protocol and baseline WAVs into one deflated ZIP
+@perf.timed('audio.zip')
+def zip_bundle(wav_files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+        for name, wav_bytes in wav_files:
+            bundle.writestr(name, wav_bytes)
+    return buffer.getvalue()
+
+
+# Function to write (name, WAV byte chunks) streams into a deflated ZIP, one
+# chunk at a time, so no whole file is held in memory
+def write_zip(file, wav_streams):
+    with zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+        for name, chunks in wav_streams:
+            with bundle.open(name, 'w', force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
@@ -0,0 +1,168 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; memory is then not reported
+    resource = None
+
+# Path of the JSON-lines timing log. Instrumentation is switched off, and costs
+# a single flag check per call site, unless this or TUG_PERF_PANEL is set.
+LOG_PATH = os.environ.get("TUG_PERF_LOG")
+# Show a debug panel with recent spans and counters at the bottom of each app
+PANEL = os.environ.get("TUG_PERF_PANEL", "") not in ("", "0")
+ENABLED = bool(LOG_PATH) or PANEL
+# Spans kept in memory for the debug panel
+RECENT_SPANS = 200
+
+_lock = threading.Lock()
+_counters = {}
+_recent = deque(maxlen=RECENT_SPANS)
+_log = None
+
+
+# Function to return the peak resident memory of the process in MiB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return round(peak / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+
+# Function to return the current resident memory of the process in MiB. Read
+# from /proc, so only reported on Linux.
+def rss_mb():
+    if resource is None:
+        return None
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return round(pages * resource.getpagesize() / 1024 ** 2, 1)
+
+
+def _difference(after, before):
+    return None if after is None or before is None else round(after - before, 1)
+
+
+# Timed section of code, logged with its duration, the resident memory at its
+# end and how much the span itself changed it. `peak_growth_mb` is how far the
+# span raised the process's peak memory, catching buffers freed before its end.
+class _Span:
+    __slots__ = ('name', 'fields', 'start', 'rss', 'peak')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.rss = rss_mb()
+        self.peak = peak_rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ms = round((time.perf_counter() - self.start) * 1000, 3)
+        rss = rss_mb()
+        record = {'span': self.name, 'ms': ms, 'rss_mb': rss, 'rss_delta_mb': _difference(rss, self.rss),
+                  'peak_growth_mb': _difference(peak_rss_mb(), self.peak), **self.fields}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        _emit(record)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# Function to time a block: `with perf.span("audio.encode", trials=3): ...`
+def span(name, **fields):
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name, fields)
+
+
+# Decorator timing every call of a function. When instrumentation is off the
+# function is returned unchanged.
+def timed(name):
+    def decorate(function):
+        if not ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Function to add to a process-wide counter, e.g. frames decoded or cache hits
+def count(name, n=1):
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def recent_spans():
+    with _lock:
+        return list(_recent)
+
+
+def _emit(record):
+    global _log
+    record = {'ts': round(time.time(), 3), 'pid': os.getpid(), 'thread': threading.current_thread().name, **record}
+    with _lock:
+        _recent.append(record)
+        if LOG_PATH:
+            if _log is None:
+                _log = open(LOG_PATH, 'a', buffering=1)
+            _log.write(json.dumps(record, default=str) + '\n')
+
+
+# Counters are written to the log once, when the process exits
+def _write_counters():
+    totals = counters()
+    if LOG_PATH and totals:
+        _emit({'counters': totals, 'peak_rss_mb': peak_rss_mb()})
+
+
+atexit.register(_write_counters)
+
+
+# Function to render the debug panel in a Streamlit app, if enabled
+def debug_panel():
+    if not PANEL:
+        return
+    import pandas as pd
+    import streamlit as st
+
+    with st.expander("Performance"):
+        st.caption(f"Memory: {rss_mb()} MiB, peak {peak_rss_mb()} MiB")
+        st.json(counters())
+        spans = recent_spans()
+        if spans:
+            st.dataframe(pd.DataFrame(spans[::-1]).drop(columns=['pid']))
@@ -0,0 +1,99 @@
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from tug_video import (PHASES_PER_TRIAL, detect_phase_candidates, get_video_frames, motion_energy,
+                       phase_averages, small_gray_chunks)
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi')
+PHASE_COLUMNS = [f"PHASE {i + 1}" for i in range(PHASES_PER_TRIAL)]
+SUMMARY_COLUMNS = ['VIDEO', 'SOURCE', 'FRAMES', 'FPS', 'SELECTED FRAMES'] + PHASE_COLUMNS + ['ERROR']
+
+
+# Function to read per-video frame selections from a CSV with the columns
+# "video" (file name) and "frames" (space-separated frame numbers)
+def read_selections(selections_file):
+    selections = {}
+    if selections_file:
+        with open(selections_file, newline='') as f:
+            for row in csv.DictReader(f):
+                selections[row['video']] = [int(frame) for frame in row['frames'].split()]
+    return selections
+
+
+# Function to compute the phase averages of one video. Runs in a worker
+# process; only the timestamps and summary row are sent back.
+def process_video(video_file, selected_frames=None):
+    row = {'VIDEO': os.path.basename(video_file), 'ERROR': ''}
+    try:
+        frames, timestamps = get_video_frames(video_file)
+        fps = frames.fps
+        frames.release()
+        # An unreadable or corrupt video opens as an empty provider
+        if not frames or not fps:
+            raise ValueError("video could not be opened or has no frames")
+
+        if selected_frames is None:
+            row['SOURCE'] = 'detected'
+            selected_frames = detect_phase_candidates(motion_energy(small_gray_chunks(video_file)), fps)
+            if not selected_frames:
+                raise ValueError("no phase transitions detected")
+        else:
+            row['SOURCE'] = 'selected'
+
+        averages = phase_averages([timestamps[i] for i in selected_frames if i < len(timestamps)])
+        row.update({'FRAMES': len(timestamps), 'FPS': fps, 'SELECTED FRAMES': ' '.join(map(str, selected_frames))})
+        row.update(zip(PHASE_COLUMNS, averages))
+    except Exception as e:
+        row['ERROR'] = str(e)
+    return row
+
+
+# Generator of summary rows, yielded as each video finishes
+def run_batch(video_files, selections, workers=None):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_video, video_file, selections.get(os.path.basename(video_file)))
+                   for video_file in video_files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute TUG phase averages for a directory of videos.")
+    parser.add_argument('video_dir', help="Directory containing the videos")
+    parser.add_argument('--selections', help="CSV with 'video' and 'frames' columns; videos without a "
+                                             "selection use auto-detected phase candidates")
+    parser.add_argument('--output', default='phase_summary.csv', help="Summary file (.csv or .parquet)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: all cores)")
+    args = parser.parse_args(argv)
+
+    video_files = sorted(os.path.join(args.video_dir, name) for name in os.listdir(args.video_dir)
+                         if name.lower().endswith(VIDEO_EXTENSIONS))
+    if not video_files:
+        parser.error(f"no videos found in {args.video_dir}")
+    selections = read_selections(args.selections)
+
+    results = run_batch(video_files, selections, args.workers)
+    if args.output.endswith('.parquet'):
+        rows = []
+        for row in results:
+            print(f"{row['VIDEO']}: {row['ERROR'] or 'done'}", file=sys.stderr)
+            rows.append(row)
+        pd.DataFrame(rows, columns=SUMMARY_COLUMNS).to_parquet(args.output, index=False)
+    else:
+        # Rows are written and flushed as soon as each video completes
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+            for row in results:
+                print(f"{row['VIDEO']}: {row['ERROR'] or 'done'}", file=sys.stderr)
+                writer.writerow(row)
+                f.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,208 @@
 import streamlit as st
-try:
-    import cv2
-    print("OpenCV version:", cv2.__version__)
-except ImportError:
-    st.info("OpenCV is not installed.")
 import numpy as np
 import pandas as pd
+import atexit
+import hashlib
+import importlib.util
+import os
+import shutil
 import tempfile
+import threading
+import weakref
+from collections import OrderedDict
 
-# Function to extract frames from the video
-def get_video_frames(video_file):
-    cap = cv2.VideoCapture(video_file)
-    frames = []
-    timestamps = []
+import perf
+from tug_video import (COARSE_FPS, PHASES_PER_TRIAL, build_coarse_index, build_proxy, detect_phase_candidates,
+                       get_video_frames, motion_energy, phase_averages, proxy_chunks, refine_window,
+                       small_gray_chunks)
 
-    if not cap.isOpened():
-        return frames, timestamps  # Return empty lists if the video cannot be opened
+# Total size of the cached videos, shared by all sessions: the uploads spilled
+# to disk, the proxy and coarse index files built from them (one per stride)
+# and the frames each one keeps decoded in memory
+UPLOAD_CACHE_BYTES = 2 * 1024 ** 3
 
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
 
-    for i in range(frame_count):
-        ret, frame = cap.read()
-        if ret:
-            frames.append(frame)
-            timestamps.append(i / fps)  # timestamp in seconds
-        else:
-            break  # Exit the loop if no frame is read
+def _proxy_path(path, grayscale):
+    return os.path.splitext(path)[0] + ('_proxy_gray.npy' if grayscale else '_proxy.npy')
+
+
+def _coarse_path(path, stride):
+    return os.path.splitext(path)[0] + f'_coarse_{stride}.npy'
+
+
+# Function to close a spilled video's capture and delete its files
+def _remove_video(frames, path, strides):
+    frames.release()
+    for file_path in [path, _proxy_path(path, False), _proxy_path(path, True)] + [_coarse_path(path, s)
+                                                                                 for s in strides]:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+
+# An uploaded video spilled to disk, with its frame provider and any proxies.
+# The capture and files are cleaned up once the last reference is dropped, so
+# evicting it from the cache never breaks a session still showing it.
+class CachedVideo:
+    def __init__(self, path, upload_bytes):
+        self.path = path
+        self.upload_bytes = upload_bytes
+        self.file_bytes = 0  # Size of the proxy and coarse index files built so far
+        self.frames, self.timestamps = get_video_frames(path)
+        self.proxies = {}  # grayscale flag -> memory-mapped proxy frames
+        self.coarse = {}  # stride -> memory-mapped downscaled frames
+        self.candidates = None
+        self.cleanup = weakref.finalize(self, _remove_video, self.frames, path, self.coarse)
+
+    # Bytes the entry counts against the cache's budget. Decoded frames come
+    # and go as the video is viewed, so this is read anew on every check.
+    @property
+    def size(self):
+        return self.upload_bytes + self.file_bytes + self.frames.cache_bytes
+
+    def proxy_path(self, grayscale):
+        return _proxy_path(self.path, grayscale)
+
+    def get_proxy(self, grayscale=False):
+        if grayscale not in self.proxies:
+            self.proxies[grayscale] = build_proxy(self.path, self.proxy_path(grayscale), grayscale=grayscale)
+            self._add_file(self.proxy_path(grayscale))
+        return self.proxies[grayscale]
+
+    def coarse_path(self, stride):
+        return _coarse_path(self.path, stride)
+
+    def get_coarse(self, stride):
+        if stride not in self.coarse:
+            thumbnails, timestamps = build_coarse_index(self.path, self.coarse_path(stride), stride)
+            self.coarse[stride] = thumbnails
+            self._add_file(self.coarse_path(stride))
+            if timestamps:
+                # The indexing pass visited every frame, so its container
+                # timestamps and frame count are exact
+                self.timestamps = timestamps
+                self.frames.frame_count = min(self.frames.frame_count, len(timestamps))
+        return self.coarse[stride]
+
+    def get_phase_candidates(self):
+        if self.candidates is None:
+            # Reuse a proxy when one was built rather than decoding again
+            proxy = next((p for p in self.proxies.values() if p is not None), None)
+            chunks = proxy_chunks(proxy) if proxy is not None else small_gray_chunks(self.path)
+            with perf.span('video.motion', source='proxy' if proxy is not None else 'decode'):
+                self.candidates = detect_phase_candidates(motion_energy(chunks), self.frames.fps)
+        return self.candidates
+
+    def _add_file(self, file_path):
+        if os.path.exists(file_path):
+            self.file_bytes += os.path.getsize(file_path)
+
+
+# Process-wide cache of uploaded videos keyed by a hash of their bytes. Least
+# recently used entries are dropped once the size cap is exceeded; their files
+# are deleted when no session uses them any more.
+class UploadCache:
+    def __init__(self, max_bytes=UPLOAD_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> CachedVideo
+        self.lock = threading.Lock()
+        self.key_locks = {}  # key -> lock held while that upload is spilled to disk
+        self.directory = tempfile.mkdtemp(prefix="tug_videos_")
+        atexit.register(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def get(self, key, file):
+        with self.lock:
+            video = self._hit(key)
+            if video is not None:
+                # Its frames may have grown the cache since the last check
+                self._evict()
+                return video
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        # The upload is written and opened outside the cache lock, so other
+        # sessions' lookups do not wait on it; sessions uploading the same
+        # file wait on the key's lock and then find it cached
+        with key_lock:
+            try:
+                with self.lock:
+                    video = self._hit(key)
+                    if video is not None:
+                        return video
+
+                data = file.getvalue()
+                perf.count('upload_bytes', len(data))
+                # A unique name, as an evicted copy may still be in use at the old one
+                fd, path = tempfile.mkstemp(suffix=os.path.splitext(file.name)[1], prefix=key + '_',
+                                            dir=self.directory)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(data)
+                    video = CachedVideo(path, len(data))
+                except Exception:
+                    os.remove(path)
+                    raise
+
+                with self.lock:
+                    self.entries[key] = video
+                    self._evict()
+                return video
+            finally:
+                # A failed upload is retried from scratch by the next session
+                with self.lock:
+                    self.key_locks.pop(key, None)
+
+    # Drop least recently used entries until the cache is within its budget,
+    # e.g. after a proxy was built for one of them
+    def trim(self):
+        with self.lock:
+            self._evict()
+
+    def _hit(self, key):
+        video = self.entries.get(key)
+        if video is not None:
+            self.entries.move_to_end(key)
+            perf.count('upload_cache_hits')
+        return video
+
+    def _evict(self):
+        # Never evict the entry that was just added, even if it alone is over
+        # the cap. Evicted videos are only forgotten here; sessions still
+        # holding one keep using it until their rerun ends.
+        while sum(video.size for video in self.entries.values()) > self.max_bytes and len(self.entries) > 1:
+            self.entries.popitem(last=False)
+
+
+@st.cache_resource
+def get_upload_cache():
+    return UploadCache()
+
+
+# Function to load an uploaded video, reusing earlier work across reruns
+def load_video(file):
+    # Hash each upload once per session; reruns look the hash up by file id
+    video_keys = st.session_state.setdefault('video_keys', {})
+    key = video_keys.get(file.file_id)
+    if key is None:
+        with perf.span('video.hash'):
+            key = hashlib.blake2b(file.getvalue(), digest_size=16).hexdigest()
+        video_keys[file.file_id] = key
+
+    return get_upload_cache().get(key, file)
+
+
+# Function to decode the frame at `index`. The container's frame count is
+# only an estimate; a read past the real end shrinks `frames`, and the last
+# frame that decodes is shown instead. Returns the index shown and its frame.
+def read_frame(frames, index):
+    while len(frames):
+        index = min(index, len(frames) - 1)
+        try:
+            return index, frames[index]
+        except IndexError:
+            continue
+    return index, None
 
-    cap.release()
-    return frames, timestamps
 
 #
 # # Function to display the selected frames and timestamps
@@ -41,121 +214,174 @@ def display_selected_frames(selected_frames, timestamps):
     })
     st.dataframe(selected_data)
 
-# Initialize session state to track the current video index
-if 'current_video_index' not in st.session_state:
-    st.session_state.current_video_index = 0  # Start with the first video
 
-# Video file upload (multiple files)
-uploaded_files = st.file_uploader("Upload video files", type=["mp4", "mov", "avi"], accept_multiple_files=True)
+def main():
+    # Initialize session state to track the current video index
+    if 'current_video_index' not in st.session_state:
+        st.session_state.current_video_index = 0  # Start with the first video
+
+    # Video file upload (multiple files)
+    uploaded_files = st.file_uploader("Upload video files", type=["mp4", "mov", "avi"], accept_multiple_files=True)
+
+    if uploaded_files:
+        if st.button("Next video"):
+            if st.session_state.current_video_index < len(uploaded_files) - 1:
+                st.session_state.current_video_index += 1  # Increment to the next video
+            else:
+                st.warning("No more videos to process.")
+        # Get the current file based on session state's video index
+        file = uploaded_files[st.session_state.current_video_index]
+        st.session_state.frame_index = 0
+
+        # Display the current video file being processed
+        st.write(f"### Currently selected video: {file.name}")
+
+        # OpenCV is only looked up here; it is loaded on first use
+        if importlib.util.find_spec("cv2") is None:
+            st.info("OpenCV is not installed.")
+            return
+
+        # Load frames and timestamps, reusing the cached upload between reruns
+        video = load_video(file)
+        frames, timestamps = video.frames, video.timestamps
 
-if uploaded_files:
-    if st.button("Next video"):
-        if st.session_state.current_video_index < len(uploaded_files) - 1:
-            st.session_state.current_video_index += 1  # Increment to the next video
+        # Proxy mode scrubs through a downscaled copy decoded once up front
+        proxy_mode = st.checkbox("Proxy mode (fast scrubbing)")
+        proxy = None
+        if proxy_mode:
+            grayscale = st.checkbox("Grayscale proxy")
+            with st.spinner("Building proxy..."):
+                proxy = video.get_proxy(grayscale)
+            get_upload_cache().trim()
+        view = proxy if proxy is not None else frames
+
+        # Coarse-to-fine navigation scrubs every Nth frame, then steps through
+        # a window around the chosen frame at the full frame rate
+        coarse = None
+        refine = False
+        if proxy is None and st.checkbox("Coarse-to-fine navigation (high-speed videos)"):
+            stride = st.number_input("Coarse stride (frames)", min_value=1,
+                                     value=max(1, round(frames.fps / COARSE_FPS)) if frames.fps else 1)
+            with st.spinner("Indexing video..."):
+                coarse = video.get_coarse(int(stride))
+            get_upload_cache().trim()
+            # Indexing reads the exact timestamps from the container
+            timestamps = video.timestamps
+
+        # Check if frames were extracted
+        if not len(view):
+            st.error("No frames were extracted from the video. Please check the video file.")
         else:
-            st.warning("No more videos to process.")
-    # Get the current file based on session state's video index
-    file = uploaded_files[st.session_state.current_video_index]
-    st.session_state.frame_index = 0
-
-    # Display the current video file being processed
-    st.write(f"### Currently selected video: {file.name}")
-
-    # Create a temporary file to store the uploaded video
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-        tmp_file.write(file.read())
-        tmp_file_path = tmp_file.name
-
-    # st.video(tmp_file_path)  # You can display the video using the temp file path
-    # Load frames and timestamps from the temporary file
-    frames, timestamps = get_video_frames(tmp_file_path)
-
-    # Check if frames were extracted
-    if not frames:
-        st.error("No frames were extracted from the video. Please check the video file.")
+            # Frame selection index
+            if 'frame_index' not in st.session_state:
+                st.session_state.frame_index = 0  # Initialize the frame index
+
+            # Frame selection display
+            st.write("### Video Player")
+
+            # Slider for frame selection
+            step = int(stride) if coarse is not None else 1
+            st.session_state.frame_index = st.slider(
+                "Frame Number", 0, len(view) - 1, st.session_state.frame_index, step=step
+            )
+            if coarse is not None:
+                refine = st.checkbox("Refine at full frame rate")
+                if refine:
+                    first, last = refine_window(st.session_state.frame_index, frames.fps, len(frames))
+                    st.session_state.frame_index = st.slider(
+                        "Refined Frame Number", first, last, st.session_state.frame_index
+                    )
+                    step = 1
+
+            # Navigation buttons
+            col1, col2 = st.columns(2)
+
+            with col1:
+                if st.button("Previous Frame"):
+                    if st.session_state.frame_index > 0:
+                        st.session_state.frame_index -= step  # Go to the previous frame
+                        st.session_state.frame_index = max(st.session_state.frame_index, 0)  # Ensure it doesn't go below 0
+
+            with col2:
+                if st.button("Next Frame"):
+                    if st.session_state.frame_index < len(view) - 1:
+                        st.session_state.frame_index += step  # Go to the next frame
+                        st.session_state.frame_index = min(st.session_state.frame_index,
+                                                           len(view) - 1)  # Ensure it doesn't exceed total frames
+
+            # Display the selected frame based on updated index
+            if coarse is not None and not refine:
+                # Show the nearest indexed frame; nothing is decoded here
+                st.image(np.asarray(coarse[min(st.session_state.frame_index // step, len(coarse) - 1)]),
+                         channels="BGR", caption=f"Frame: {st.session_state.frame_index} (every {step})")
+            elif proxy is None:
+                st.session_state.frame_index, selected_frame = read_frame(frames, st.session_state.frame_index)
+                if selected_frame is None:
+                    st.error("No frames could be decoded from the video. Please check the video file.")
+                else:
+                    st.image(selected_frame, channels="BGR", caption=f"Frame: {st.session_state.frame_index}")
+                    frames.prefetch(st.session_state.frame_index)
+            else:
+                selected_frame = view[st.session_state.frame_index]
+                st.image(np.asarray(selected_frame), channels="RGB" if selected_frame.ndim == 2 else "BGR",
+                         caption=f"Frame: {st.session_state.frame_index} (proxy)")
+                show_original = st.checkbox("Show original frame on select")
+
+            # Select frame button
+            if st.button("Select Frame"):
+                if 'selected_frames' not in st.session_state:
+                    st.session_state.selected_frames = []
+                st.session_state.selected_frames.append(st.session_state.frame_index)
+
+                # Full-resolution decode only happens here, on request
+                if proxy is not None and show_original:
+                    index, original = read_frame(frames, st.session_state.frame_index)
+                    if original is not None:
+                        st.image(original, channels="BGR", caption=f"Frame: {index} (original)")
+
+            # Propose phase boundaries from motion for the user to confirm
+            if st.button("Detect Phase Candidates"):
+                with st.spinner("Analysing motion..."):
+                    candidates = video.get_phase_candidates()
+                if candidates:
+                    st.session_state.selected_frames = list(candidates)
+                    st.info(f"{len(candidates) // PHASES_PER_TRIAL} trial(s) detected. Please review the proposed frames below.")
+                else:
+                    st.warning("No phase transitions could be detected in this video.")
+
+            # Display selected frames
+            if 'selected_frames' in st.session_state:
+                display_selected_frames(st.session_state.selected_frames, timestamps)
+
+            # Save button
+            # if st.button("Save Selected Frames"):
+            #     selected_frames = st.session_state.selected_frames
+            #     if selected_frames:
+            #         with open("selected_frames.txt", "w") as f:
+            #             for frame in selected_frames:
+            #                 f.write(f"Frame: {frame}, Timestamp: {timestamps[frame]}\n")
+            #         st.success("Selected frames saved to selected_frames.txt")
+            #     else:
+            #         st.warning("No frames selected to save.")
+
+            if st.button('Average Phase Time'):
+                averages = phase_averages(
+                    [(timestamps[i]) for i in st.session_state.selected_frames if i < len(timestamps)]
+                )
+
+                averages_str = ' '.join(f"{avg:.2f}" for avg in averages)
+
+                # Display the averages in Streamlit without brackets
+                st.info('INTERVAL SPACING TO BE COPIED INTO SYNC-TUG:')
+                st.success(averages_str)
+                # st.info(averages)
+
+
     else:
-        # Frame selection index
-        if 'frame_index' not in st.session_state:
-            st.session_state.frame_index = 0  # Initialize the frame index
-
-        # Frame selection display
-        st.write("### Video Player")
-
-        # Slider for frame selection
-        st.session_state.frame_index = st.slider(
-            "Frame Number", 0, len(frames) - 1, st.session_state.frame_index
-        )
-
-        # Display selected frame based on the current frame index
-        selected_frame = frames[st.session_state.frame_index]
-        # st.image(selected_frame, channels="BGR", caption=f"Frame: {st.session_state.frame_index}")
-
-        # Navigation buttons
-        col1, col2 = st.columns(2)
-
-        with col1:
-            if st.button("Previous Frame"):
-                if st.session_state.frame_index > 0:
-                    st.session_state.frame_index -= 1  # Go to the previous frame
-                    st.session_state.frame_index = max(st.session_state.frame_index, 0)  # Ensure it doesn't go below 0
-
-        with col2:
-            if st.button("Next Frame"):
-                if st.session_state.frame_index < len(frames) - 1:
-                    st.session_state.frame_index += 1  # Go to the next frame
-                    st.session_state.frame_index = min(st.session_state.frame_index,
-                                                       len(frames) - 1)  # Ensure it doesn't exceed total frames
-
-        # Display the selected frame based on updated index
-        selected_frame = frames[st.session_state.frame_index]
-        st.image(selected_frame, channels="BGR", caption=f"Frame: {st.session_state.frame_index}")
-
-        # Select frame button
-        if st.button("Select Frame"):
-            if 'selected_frames' not in st.session_state:
-                st.session_state.selected_frames = []
-            st.session_state.selected_frames.append(st.session_state.frame_index)
-
-        # Display selected frames
-        if 'selected_frames' in st.session_state:
-            display_selected_frames(st.session_state.selected_frames, timestamps)
-
-        # Save button
-        # if st.button("Save Selected Frames"):
-        #     selected_frames = st.session_state.selected_frames
-        #     if selected_frames:
-        #         with open("selected_frames.txt", "w") as f:
-        #             for frame in selected_frames:
-        #                 f.write(f"Frame: {frame}, Timestamp: {timestamps[frame]}\n")
-        #         st.success("Selected frames saved to selected_frames.txt")
-        #     else:
-        #         st.warning("No frames selected to save.")
-
-        if st.button('Average Phase Time'):
-            # Sample DataFrame with timestamps (replace this with your actual DataFrame)
-            data = {
-                'timestamps': [(timestamps[i]) for i in st.session_state.selected_frames if i < len(timestamps)]
-            }
-
-            df = pd.DataFrame(data)
-
-            # Group by the pattern 1, 7, 13; 2, 8, 14, and so on
-            averages = []
-
-            # Loop over 6 groups: 1, 7, 13; 2, 8, 14; ..., 6, 12, 18
-            for i in range(6):
-                # Select every 6th element starting from index i
-                group = df['timestamps'].iloc[i::6]
-                avg = round(group.mean(), 2)  # Calculate the average of the group
-                averages.append(float(avg))
-                
-            averages_str = ' '.join(f"{avg:.2f}" for avg in averages)
-
-            # Display the averages in Streamlit without brackets
-            st.info('INTERVAL SPACING TO BE COPIED INTO SYNC-TUG:')
-            st.success(averages_str)
-            # st.info(averages)
-
-
-else:
-    st.write("Please upload at least one video file.")
+        st.write("Please upload at least one video file.")
+
+    perf.debug_panel()
+
+
+if __name__ == "__main__":
+    main()
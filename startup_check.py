@@ -0,0 +1,91 @@
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+# Apps whose module-level imports run at the start of every session, next to
+# this script
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APPS = [os.path.join(APP_DIR, app) for app in ('phase_timer.py', 'click_met.py', 'gs_db.py')]
+# Seconds a fresh interpreter may spend on an app's module-level imports
+IMPORT_BUDGET_SECONDS = 2.0
+# Heavy modules the apps load on first use, never at startup
+LAZY_MODULES = ['cv2', 'matplotlib', 'seaborn']
+# Slowest imports listed for an app that is over budget
+SLOWEST_IMPORTS = 10
+
+# Run in a fresh interpreter: executes the import statements and reports how
+# long they took and which of the lazy modules they pulled in
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+exec(compile({source!r}, {app!r}, 'exec'))
+print(json.dumps({{'seconds': time.perf_counter() - start,
+                  'loaded': [name for name in {lazy!r} if name in sys.modules]}}))
+"""
+
+
+# Function to collect the import statements at the top level of an app,
+# including guarded `try: import ...` blocks. Only these run at startup;
+# imports inside functions are deferred to first use.
+def module_imports(path):
+    with open(path) as f:
+        source = f.read()
+    tree = ast.parse(source, filename=path)
+    imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))
+               or isinstance(node, ast.Try) and any(isinstance(child, (ast.Import, ast.ImportFrom))
+                                                    for child in node.body)]
+    return '\n'.join(ast.get_source_segment(source, node) for node in imports)
+
+
+# Function to parse the output of `python -X importtime` into (cumulative
+# seconds, module) pairs of the slowest imports
+def slowest_imports(importtime_log, count=SLOWEST_IMPORTS):
+    imports = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((int(cumulative) / 1e6, module.rstrip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+# Function to profile the startup imports of one app in a fresh interpreter
+def profile_app(app):
+    code = CHILD.format(source=module_imports(app), app=app, lazy=LAZY_MODULES)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(app)))
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {app} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['slowest'] = slowest_imports(result.stderr)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the apps' startup imports stay within budget.")
+    parser.add_argument('apps', nargs='*', default=APPS, help="App scripts to check (default: all)")
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_SECONDS,
+                        help="Seconds allowed per app (default: %(default)s)")
+    parser.add_argument('--verbose', action='store_true', help="List the slowest imports of every app")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for app in args.apps:
+        report = profile_app(app)
+        over_budget = report['seconds'] > args.budget
+        status = 'OVER BUDGET' if over_budget else 'ok'
+        print(f"{os.path.basename(app):20s} {report['seconds']:6.2f} s  {status}")
+        if report['loaded']:
+            print(f"  loads at startup: {', '.join(report['loaded'])}")
+        if over_budget or args.verbose:
+            for seconds, module in report['slowest']:
+                print(f"  {seconds:6.3f} s  {module}")
+        failed = failed or over_budget or bool(report['loaded'])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tug_stats import TugSummary
+from tug_store import GSheetsBackend, MemorySheetBackend, TugStore
+
+
+def records(n, start=0):
+    return pd.DataFrame({
+        "SUBJECT'S NAME": [f"subject_{i}" for i in range(start, start + n)],
+        "SUBJECT'S AGE": [60 + i for i in range(start, start + n)],
+        "ICD": ["Healthy", "Impairments"] * (n // 2) + ["Healthy"] * (n % 2),
+        "TUG-INITIAL": [15.0 + i for i in range(start, start + n)],
+        "TUG-FINAL": [14.0 + i for i in range(start, start + n)],
+        "TUG-DIFFERENCE": [1.0] * n,
+    })
+
+
+# Backend whose next `failures` calls of `method` raise, like a rate-limited API
+class FlakyBackend(MemorySheetBackend):
+    def __init__(self, data, method, failures=1):
+        super().__init__(data)
+        self.method = method
+        self.failures = failures
+
+    def append_rows(self, rows, columns):
+        self._maybe_fail('append_rows')
+        return super().append_rows(rows, columns)
+
+    def update_rows(self, rows, columns):
+        self._maybe_fail('update_rows')
+        super().update_rows(rows, columns)
+
+    def _maybe_fail(self, method):
+        if method == self.method and self.failures:
+            self.failures -= 1
+            raise ConnectionError("quota exceeded")
+
+
+@pytest.fixture
+def open_store(tmp_path):
+    stores = []
+
+    def open_store(backend):
+        store = TugStore(str(tmp_path / "store.sqlite"), backend, start=False, summary=TugSummary())
+        stores.append(store)
+        return store
+
+    yield open_store
+    for store in stores:
+        store.close()
+
+
+def test_edits_of_an_unsent_append_coalesce_into_one_append(open_store):
+    backend = MemorySheetBackend(records(3))
+    store = open_store(backend)
+
+    store.append(records(1, start=3))
+    row = store.read().loc[[3]]
+    for final in (10.0, 9.0):
+        row['TUG-FINAL'] = final
+        store.update(row)
+    assert store.pending() == 1
+
+    store.flush()
+    assert backend.calls['append_rows'] == 1
+    assert backend.calls['update_rows'] == 0
+    assert backend.data.loc[3, 'TUG-FINAL'] == 9.0
+    assert len(backend.data) == 4
+
+
+def test_repeated_updates_of_a_row_are_sent_once(open_store):
+    backend = MemorySheetBackend(records(3))
+    store = open_store(backend)
+
+    row = store.read().loc[[1]]
+    for final in (5.0, 6.0, 7.0):
+        row['TUG-FINAL'] = final
+        store.update(row)
+
+    store.flush()
+    assert backend.calls['update_rows'] == 1
+    assert backend.cells_sent == len(row.columns)
+    assert backend.data.loc[1, 'TUG-FINAL'] == 7.0
+
+
+def test_failed_append_is_retried_without_duplicating_rows(open_store):
+    backend = FlakyBackend(records(3), 'append_rows')
+    store = open_store(backend)
+
+    store.append(records(2, start=3))
+    with pytest.raises(ConnectionError):
+        store.sync_once()
+    assert store.pending() == 2
+
+    store.flush()
+    store.flush()
+    assert store.pending() == 0
+    assert backend.data["SUBJECT'S NAME"].tolist() == [f"subject_{i}" for i in range(5)]
+
+
+def test_failed_update_does_not_resend_appended_rows(open_store):
+    backend = FlakyBackend(records(3), 'update_rows')
+    store = open_store(backend)
+
+    row = store.read().loc[[0]]
+    row['TUG-FINAL'] = 1.0
+    store.update(row)
+    store.append(records(1, start=3))
+    with pytest.raises(ConnectionError):
+        store.sync_once()
+
+    store.flush()
+    assert backend.calls['append_rows'] == 1
+    assert len(backend.data) == 4
+    assert backend.data.loc[0, 'TUG-FINAL'] == 1.0
+
+
+def test_entries_for_missing_rows_are_settled_without_a_call(open_store):
+    backend = MemorySheetBackend(records(3))
+    store = open_store(backend)
+
+    store.update(records(1).set_axis([42]))
+    assert store.pending() == 1
+
+    store.sync_once()
+    assert store.pending() == 0
+    assert backend.calls['update_rows'] == 0
+
+
+def test_replace_renumbers_rows_after_blank_sheet_rows(open_store):
+    data = records(6).astype(object)
+    data.iloc[2] = np.nan  # A blank row in the middle of the sheet
+    backend = MemorySheetBackend(data)
+    store = open_store(backend)
+    assert store.read().index.tolist() == [0, 1, 3, 4, 5]
+
+    store.replace(store.read())
+    store.flush()
+    row = store.read().loc[[4]]
+    row['TUG-FINAL'] = 0.0
+    store.update(row)
+    store.flush()
+
+    assert backend.data["SUBJECT'S NAME"].tolist() == ["subject_0", "subject_1", "subject_3", "subject_4",
+                                                        "subject_5"]
+    assert backend.data.loc[4, 'TUG-FINAL'] == 0.0
+
+
+def test_append_after_a_blank_row_is_relabelled_to_where_the_sheet_put_it(open_store):
+    data = records(5).astype(object)
+    data.iloc[2] = np.nan  # Sheets appends at this gap and pushes the rows below down
+    backend = MemorySheetBackend(data)
+    store = open_store(backend)
+
+    store.append(records(1, start=100))
+    store.flush()
+    assert store.read()["SUBJECT'S NAME"].to_dict() == {0: "subject_0", 1: "subject_1", 2: "subject_100",
+                                                         4: "subject_3", 5: "subject_4"}
+
+    rows = store.read().loc[[2, 5]]
+    rows['TUG-FINAL'] = -1.0
+    store.update(rows)
+    store.flush()
+    assert backend.data.loc[2, "SUBJECT'S NAME"] == "subject_100"
+    assert backend.data.loc[[2, 5], 'TUG-FINAL'].tolist() == [-1.0, -1.0]
+    assert backend.data.loc[4, 'TUG-FINAL'] == 17.0
+
+
+def test_appends_from_two_stores_keep_both_rows(tmp_path):
+    backend = MemorySheetBackend(records(3))
+    first = TugStore(str(tmp_path / "first.sqlite"), backend, start=False)
+    second = TugStore(str(tmp_path / "second.sqlite"), backend, start=False)
+    try:
+        first.append(records(1, start=100))
+        first.flush()
+        second.append(records(1, start=200))
+        second.flush()
+        row = second.read().loc[second.read()["SUBJECT'S NAME"] == "subject_200"]
+        assert row.index.tolist() == [4]
+        row['TUG-FINAL'] = -99.0
+        second.update(row)
+        second.flush()
+    finally:
+        first.close()
+        second.close()
+
+    assert backend.data["SUBJECT'S NAME"].tolist() == ["subject_0", "subject_1", "subject_2", "subject_100",
+                                                        "subject_200"]
+    assert backend.data['TUG-FINAL'].tolist() == [14.0, 15.0, 16.0, 114.0, -99.0]
+
+
+def test_queued_update_follows_its_subject_after_rows_moved_on_the_sheet(tmp_path):
+    backend = MemorySheetBackend(records(4))
+    path = str(tmp_path / "store.sqlite")
+    store = TugStore(path, backend, start=False)
+    row = store.read().loc[[1]]
+    row['TUG-FINAL'] = -1.0
+    store.update(row)
+    store.close()
+
+    # Another client sorts a new subject to the top while the edit is queued
+    backend.data = pd.concat([records(1, start=50), backend.data], ignore_index=True)
+    store = TugStore(path, backend, start=False)
+    try:
+        store.flush()
+        assert store.read()["SUBJECT'S NAME"].tolist() == ["subject_50", "subject_0", "subject_1", "subject_2",
+                                                            "subject_3"]
+    finally:
+        store.close()
+    assert backend.data['TUG-FINAL'].tolist() == [64.0, 14.0, -1.0, 16.0, 17.0]
+    assert backend.calls['update_rows'] == 1
+
+
+def test_update_of_a_subject_removed_elsewhere_is_appended_again(open_store):
+    backend = MemorySheetBackend(records(4))
+    store = open_store(backend)
+    row = store.read().loc[[1]]
+    row['TUG-FINAL'] = -1.0
+    store.update(row)
+
+    backend.data = backend.data.drop(index=1).reset_index(drop=True)
+    store.flush()
+    assert backend.data["SUBJECT'S NAME"].tolist() == ["subject_0", "subject_2", "subject_3", "subject_1"]
+    assert backend.data['TUG-FINAL'].tolist() == [14.0, 16.0, 17.0, -1.0]
+    assert backend.calls['update_rows'] == 0
+
+
+def assert_summary_matches(store):
+    expected, summary = TugSummary(store.read()), store.summary
+    assert (summary.age_counts == expected.age_counts).all()
+    for column in expected.score_counts:
+        assert (summary.score_counts[column] == expected.score_counts[column]).all()
+        np.testing.assert_allclose(summary.score_moments[column], expected.score_moments[column])
+    assert (summary.improved, summary.not_improved) == (expected.improved, expected.not_improved)
+    assert summary.icd_counts == expected.icd_counts
+
+
+def test_summary_follows_appends_updates_and_replace(open_store):
+    store = open_store(MemorySheetBackend(records(4)))
+    assert_summary_matches(store)
+
+    store.append(records(2, start=4))
+    assert_summary_matches(store)
+
+    rows = store.read().loc[[1, 5]]
+    rows['TUG-FINAL'] = 3.0
+    rows['TUG-DIFFERENCE'] = rows['TUG-INITIAL'] - rows['TUG-FINAL']
+    rows['ICD'] = "Complaints"
+    store.update(rows)
+    assert_summary_matches(store)
+
+    store.replace(store.read().iloc[::2])
+    assert_summary_matches(store)
+    assert store.summary.improved + store.summary.not_improved == 3
+
+
+# Connection without row-level writes, like GSheetsBackend's fallback
+class ReplaceOnlyConnection:
+    def __init__(self, data):
+        self.data = data
+        self.updates = []
+
+    def read(self, worksheet, ttl):
+        return self.data.copy()
+
+    def update(self, worksheet, data):
+        self.updates.append(data.copy())
+        self.data = data.copy()
+
+
+def test_backend_without_row_writes_replaces_the_whole_worksheet(open_store):
+    data = records(4).astype(object)
+    data.iloc[1] = np.nan
+    conn = ReplaceOnlyConnection(data)
+    store = open_store(GSheetsBackend(conn, 'TUG_SCORE'))
+    assert store.read().index.tolist() == [0, 1, 2]
+
+    store.append(records(1, start=4))
+    row = store.read().loc[[0]]
+    row['TUG-FINAL'] = 0.0
+    store.update(row)
+    store.flush()
+
+    assert len(conn.updates) == 1
+    assert conn.data["SUBJECT'S NAME"].tolist() == ["subject_0", "subject_2", "subject_3", "subject_4"]
+    assert conn.data.loc[0, 'TUG-FINAL'] == 0.0
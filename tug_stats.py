@@ -0,0 +1,76 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+# Bin edges of the age histogram, in years
+AGE_BINS = np.arange(0, 125, 5)
+# Bin edges of the TUG score histograms, in seconds
+SCORE_BINS = np.arange(0, 61, 1.0)
+SCORE_COLUMNS = ['TUG-INITIAL', 'TUG-FINAL']
+# TUG-DIFFERENCE, in seconds, counted as a clinically relevant improvement
+IMPROVEMENT_THRESHOLD = 2
+
+
+def _numeric(rows, column, dropna=True):
+    if column not in rows:
+        return np.zeros(0)
+    values = pd.to_numeric(rows[column], errors='coerce').to_numpy(dtype=float)
+    return values[~np.isnan(values)] if dropna else values
+
+
+# Function to count values per bin. Values outside the edges are counted in
+# the first or last bin so every row shows up in the plots.
+def _histogram(values, bins):
+    return np.histogram(np.clip(values, bins[0], bins[-1]), bins=bins)[0]
+
+
+# Summaries behind the "Generate Plots" charts, maintained incrementally as
+# rows are added, changed or removed so plotting never rescans the raw rows.
+class TugSummary:
+    def __init__(self, data=None):
+        self.reset(pd.DataFrame() if data is None else data)
+
+    def reset(self, data):
+        self.age_counts = np.zeros(len(AGE_BINS) - 1, dtype=np.int64)
+        self.score_counts = {column: np.zeros(len(SCORE_BINS) - 1, dtype=np.int64) for column in SCORE_COLUMNS}
+        self.score_moments = {column: np.zeros(3) for column in SCORE_COLUMNS}  # count, sum, sum of squares
+        self.improved = 0
+        self.not_improved = 0
+        self.icd_counts = Counter()  # ICD labels of subjects below the improvement threshold
+        self.add(data)
+
+    def add(self, rows):
+        self._apply(rows, 1)
+
+    def remove(self, rows):
+        self._apply(rows, -1)
+
+    # Function to return (count, mean, standard deviation) of a score column
+    def score_stats(self, column):
+        count, total, squares = self.score_moments[column]
+        if count == 0:
+            return 0, float('nan'), float('nan')
+        mean = total / count
+        return int(count), mean, float(np.sqrt(max(squares / count - mean ** 2, 0.0)))
+
+    def _apply(self, rows, sign):
+        if len(rows) == 0:
+            return
+
+        self.age_counts += sign * _histogram(_numeric(rows, "SUBJECT'S AGE"), AGE_BINS)
+        for column in SCORE_COLUMNS:
+            values = _numeric(rows, column)
+            self.score_counts[column] += sign * _histogram(values, SCORE_BINS)
+            self.score_moments[column] += sign * np.array([len(values), values.sum(), (values ** 2).sum()])
+
+        # Missing differences count as neither improved nor not improved
+        difference = _numeric(rows, 'TUG-DIFFERENCE', dropna=False)
+        not_improved = difference < IMPROVEMENT_THRESHOLD
+        self.improved += sign * int((difference >= IMPROVEMENT_THRESHOLD).sum())
+        self.not_improved += sign * int(not_improved.sum())
+
+        if 'ICD' in rows:
+            for label, count in Counter(rows['ICD'].to_numpy()[not_improved]).items():
+                self.icd_counts[label] += sign * count
+            self.icd_counts = +self.icd_counts  # Drop labels whose count fell to zero
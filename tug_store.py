@@ -0,0 +1,472 @@
+import json
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+
+import perf
+
+# Seconds between write-behind sync attempts
+SYNC_INTERVAL = 2.0
+# Longest wait, in seconds, between retries while the remote keeps failing
+MAX_SYNC_BACKOFF = 300.0
+# Seconds before the local copy is refreshed from the remote worksheet
+REFRESH_TTL = 300.0
+
+# Outbox row standing for "upload the whole table", e.g. after a schema change
+REPLACE_ALL = -1
+# Columns identifying a subject's row, checked before the row is overwritten
+KEY_COLUMNS = ["SUBJECT'S NAME", "DATE"]
+
+
+# Function to convert rows to plain cell values in the given column order
+def sheet_values(rows, columns):
+    rows = rows.reindex(columns=columns)
+    return rows.astype(object).where(rows.notna(), "").values.tolist()
+
+
+# Function to find the rows of `edited` that differ from `snapshot`. Returns
+# None when rows were added or removed, as positions can no longer be matched.
+def changed_rows(snapshot, edited):
+    if not snapshot.index.equals(edited.index) or not snapshot.columns.equals(edited.columns):
+        return None
+    before, after = snapshot.astype(object), edited.astype(object)
+    differs = (before != after) & ~(before.isna() & after.isna())
+    return edited.index[differs.any(axis=1)]
+
+
+# Interface the store syncs through. Row index labels are the rows' positions
+# below the header row of the worksheet. append_rows() returns the label the
+# first new row was written at, read_rows() the current values of the rows at
+# the given labels. A backend without `row_writes` only supports read() and
+# replace(); the store then uploads the whole table on every sync.
+class SheetBackend:
+    row_writes = True
+
+    def read(self):
+        raise NotImplementedError
+
+    def read_rows(self, labels, columns):
+        raise NotImplementedError
+
+    def append_rows(self, rows, columns):
+        raise NotImplementedError
+
+    def update_rows(self, rows, columns):
+        raise NotImplementedError
+
+    def replace(self, data):
+        raise NotImplementedError
+
+
+# Backend reading and replacing a worksheet through a streamlit_gsheets
+# connection. Row-level appends and updates need a gspread Spreadsheet opened
+# with our own client, as the connection (st-gsheets-connection 0.1) exposes
+# no public worksheet handle; without one every write is a full replace.
+class GSheetsBackend(SheetBackend):
+    def __init__(self, conn, worksheet, spreadsheet=None):
+        self.conn = conn
+        self.worksheet = worksheet
+        self.spreadsheet = spreadsheet
+        self.row_writes = spreadsheet is not None
+        self.sheet = None
+
+    def read(self):
+        # ttl=0 bypasses the connection's own st.cache_data layer
+        with perf.span('sheets.read', worksheet=self.worksheet):
+            data = self.conn.read(worksheet=self.worksheet, ttl=0).dropna(how="all")
+        # Full replaces write rows without gaps, so positions are renumbered
+        # to match when rows are never addressed individually
+        return data if self.row_writes else data.reset_index(drop=True)
+
+    def read_rows(self, labels, columns):
+        with perf.span('sheets.read_rows', rows=len(labels)):
+            values = self._select_worksheet().batch_get([self._row_range(label, len(columns)) for label in labels])
+        # Trailing blank cells and blank rows are left out of the response
+        rows = [(list(value_range[0]) if value_range else []) for value_range in values]
+        return pd.DataFrame([row + [""] * (len(columns) - len(row)) for row in rows], index=labels,
+                            columns=columns)
+
+    def append_rows(self, rows, columns):
+        # Only the new rows are sent; the append itself is atomic, so
+        # concurrent submissions cannot overwrite each other
+        perf.count('sheet_cells_uploaded', rows.shape[0] * len(columns))
+        with perf.span('sheets.append', rows=rows.shape[0]):
+            response = self._select_worksheet().append_rows(
+                sheet_values(rows, columns), value_input_option="USER_ENTERED", insert_data_option="INSERT_ROWS",
+                table_range="A1")
+        # Sheets inserts after the table starting at A1, i.e. at its first
+        # blank row, which need not be the end of the worksheet
+        first_cell = response['updates']['updatedRange'].split('!')[-1].split(':')[0]
+        return a1_to_rowcol(first_cell)[0] - 2
+
+    def update_rows(self, rows, columns):
+        # Every row is overwritten in place by one batched request
+        ranges = [{'range': self._row_range(label, len(columns)), 'values': [values]}
+                  for label, values in zip(rows.index, sheet_values(rows, columns))]
+        perf.count('sheet_cells_uploaded', rows.shape[0] * len(columns))
+        with perf.span('sheets.update', rows=rows.shape[0]):
+            self._select_worksheet().batch_update(ranges, value_input_option="USER_ENTERED")
+
+    def replace(self, data):
+        perf.count('sheet_cells_uploaded', data.size)
+        with perf.span('sheets.replace', rows=data.shape[0]):
+            self.conn.update(worksheet=self.worksheet, data=data)
+
+    @staticmethod
+    def _row_range(label, width):
+        return f"{rowcol_to_a1(label + 2, 1)}:{rowcol_to_a1(label + 2, width)}"
+
+    def _select_worksheet(self):
+        if self.sheet is None:
+            self.sheet = self.spreadsheet.worksheet(self.worksheet)
+        return self.sheet
+
+
+# Backend keeping the worksheet in memory, standing in for Google Sheets in
+# tests and benchmarks. `latency` adds a delay to every call. Like the real
+# worksheet, blank rows are kept in `data` but dropped by read(), so the
+# labels read back are sheet positions with gaps.
+class MemorySheetBackend(SheetBackend):
+    def __init__(self, data=None, latency=0.0):
+        self.data = pd.DataFrame() if data is None else data.reset_index(drop=True)
+        self.latency = latency
+        self.calls = {'read': 0, 'read_rows': 0, 'append_rows': 0, 'update_rows': 0, 'replace': 0}
+        self.cells_sent = 0
+
+    def read(self):
+        self._call('read')
+        return self.data.dropna(how="all").copy()
+
+    def read_rows(self, labels, columns):
+        self._call('read_rows')
+        return self.data.reindex(index=labels, columns=list(columns))
+
+    def append_rows(self, rows, columns):
+        self._call('append_rows', rows.shape[0] * len(columns))
+        # Like Sheets, insert at the first blank row and push the rows below down
+        blank = self.data.index[self.data.isna().all(axis=1)]
+        start = int(blank[0]) if len(blank) else len(self.data)
+        self.data = pd.concat([self.data.iloc[:start], rows.reindex(columns=columns), self.data.iloc[start:]],
+                              ignore_index=True)
+        return start
+
+    def update_rows(self, rows, columns):
+        self._call('update_rows', rows.shape[0] * len(columns))
+        for label, values in zip(rows.index, sheet_values(rows, columns)):
+            self.data.loc[label, list(columns)] = values
+
+    def replace(self, data):
+        self._call('replace', data.size)
+        self.data = data.reset_index(drop=True).copy()
+
+    def _call(self, name, cells=0):
+        self.calls[name] += 1
+        self.cells_sent += cells
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+# Local SQLite copy of a worksheet, used as the primary read/write path. Writes
+# go to the local table and are recorded in an outbox; a background thread
+# pushes the outbox to the backend in batches, retrying with backoff while the
+# remote is slow or rate-limited. Because the outbox holds row ids rather than
+# values, repeated edits of a row coalesce into a single write. New rows get
+# provisional ids and are relabelled to the positions the remote appended them
+# at. Before a row is overwritten in place, its `key_columns` on the remote are
+# checked against the values the edit started from, in case rows were moved
+# elsewhere. An optional `summary` (see tug_stats.TugSummary) is kept up to
+# date with every change.
+class TugStore:
+    def __init__(self, path, backend, ttl=REFRESH_TTL, interval=SYNC_INTERVAL, start=True, summary=None,
+                 key_columns=KEY_COLUMNS):
+        self.backend = backend
+        self.summary = summary
+        self.key_columns = key_columns
+        self.ttl = ttl
+        self.interval = interval
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.version = 0  # Bumped on every local change, for caches keyed on the data
+        self.last_error = None
+        self.last_pull = 0.0
+        self.frame = None
+
+        with self.lock:
+            # `expected` holds the key values the remote row had before the
+            # queued update, as JSON
+            self.db.execute("CREATE TABLE IF NOT EXISTS outbox "
+                            "(row_id INTEGER PRIMARY KEY, op TEXT NOT NULL, version INTEGER NOT NULL, expected TEXT)")
+            if 'expected' not in [row[1] for row in self.db.execute("PRAGMA table_info(outbox)")]:
+                self.db.execute("ALTER TABLE outbox ADD COLUMN expected TEXT")
+            self.db.commit()
+        if not self._has_records():
+            self.pull()
+        elif summary is not None:
+            summary.reset(self.read())
+
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="tug-store-sync", daemon=True)
+        if start:
+            self.thread.start()
+
+    def read(self):
+        with self.lock:
+            if self.frame is None:
+                if self._has_records():
+                    self.frame = pd.read_sql_query("SELECT * FROM records ORDER BY row_id", self.db,
+                                                   index_col='row_id').rename_axis(None)
+                else:
+                    self.frame = pd.DataFrame()
+            return self.frame.copy()
+
+    def append(self, rows):
+        with self.lock:
+            if not self._has_records():
+                # A new table has no header on the remote yet, so upload it whole
+                self._write_table(rows.reset_index(drop=True))
+                self._queue([REPLACE_ALL], 'replace')
+                return
+
+            columns = self._columns()
+            start = self.db.execute("SELECT COALESCE(MAX(row_id) + 1, 0) FROM records").fetchone()[0]
+            rows = rows.reindex(columns=columns).set_axis(range(start, start + len(rows)))
+            placeholders = ', '.join('?' * (len(columns) + 1))
+            self.db.executemany(
+                f"INSERT INTO records (row_id, {', '.join(map(_quote, columns))}) VALUES ({placeholders})",
+                [[label] + values for label, values in zip(rows.index, self._values(rows))])
+            self._queue(rows.index, 'append')
+            if self.summary is not None:
+                self.summary.add(rows)
+
+    def update(self, rows):
+        with self.lock:
+            columns = self._columns()
+            before = self.read()
+            before = before.loc[before.index.intersection(rows.index)]
+            expected = dict(zip(before.index, self._keys(before)))
+            if self.summary is not None:
+                self.summary.remove(before)
+                self.summary.add(rows.loc[rows.index.isin(before.index)].reindex(columns=columns))
+            assignments = ', '.join(f"{_quote(column)} = ?" for column in columns)
+            self.db.executemany(
+                f"UPDATE records SET {assignments} WHERE row_id = ?",
+                [values + [label] for label, values in zip(rows.index, self._values(rows.reindex(columns=columns)))])
+            self._queue(rows.index, 'update', [expected.get(label) for label in rows.index])
+
+    def replace(self, data):
+        with self.lock:
+            # The remote is rewritten without gaps, so the row ids must become
+            # the new sheet positions; labels of dropped blank rows would make
+            # later row updates land on the wrong sheet rows
+            self._write_table(data.reset_index(drop=True))
+            self.db.execute("DELETE FROM outbox")
+            self._queue([REPLACE_ALL], 'replace')
+
+    def pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    # Push pending changes, then reload the local copy from the remote
+    def refresh(self):
+        self.flush()
+        self.pull()
+
+    def flush(self):
+        while self.pending():
+            self.sync_once()
+
+    def pull(self):
+        with self.lock:
+            version = self.version
+        data = self.backend.read()
+        with self.lock:
+            # Local changes made while reading win; they have not reached the remote yet
+            if self.version == version and not self.pending():
+                self._write_table(data)
+                self.last_pull = time.monotonic()
+
+    # Send one batch of outbox entries to the backend
+    def sync_once(self):
+        with self.sync_lock:
+            with self.lock:
+                pending = self.db.execute("SELECT row_id, op, version FROM outbox ORDER BY row_id").fetchall()
+                if not pending:
+                    return 0
+                expected = dict(self.db.execute("SELECT row_id, expected FROM outbox"))
+                data = self.read()
+                columns = data.columns
+
+            if not self.backend.row_writes or any(op == 'replace' for _, op, _ in pending):
+                self.backend.replace(data)
+                self._settle(pending, data)
+                return len(pending)
+
+            # Entries for rows that no longer exist locally have nothing to send
+            stale = [entry for entry in pending if entry[0] not in data.index]
+            if stale:
+                self._settle(stale)
+
+            # Appends go first and are settled on their own, so a failed update
+            # can never cause the same rows to be appended twice
+            appends = [entry for entry in pending if entry[1] == 'append' and entry[0] in data.index]
+            updates = [entry for entry in pending if entry[1] == 'update' and entry[0] in data.index]
+            if appends:
+                row_ids = [row_id for row_id, _, _ in appends]
+                start = self.backend.append_rows(data.loc[row_ids], columns)
+                self._relabel(row_ids, start)
+                self._settle([(start + i, op, version) for i, (_, op, version) in enumerate(appends)],
+                             data.loc[row_ids].set_axis(range(start, start + len(row_ids))))
+                # The rows below the new ones have moved down with them
+                updates = [(row_id + len(row_ids) if row_id >= start else row_id, op, version)
+                           for row_id, op, version in updates]
+                data = self.read()
+                expected = dict(self.db.execute("SELECT row_id, expected FROM outbox"))
+            if updates:
+                labels = [row_id for row_id, _, _ in updates]
+                # Rows are written by position, so each target row must still
+                # hold the subject the edit started from; rows added or removed
+                # elsewhere since the last pull would have moved it
+                current = self._keys(self.backend.read_rows(labels, columns))
+                if any(expected.get(label) not in (None, key) for label, key in zip(labels, current)):
+                    perf.count('sheet_rows_moved')
+                    self._rebase()
+                    return len(pending)
+                self.backend.update_rows(data.loc[labels], columns)
+                self._settle(updates, data)
+            return len(pending)
+
+    def close(self):
+        self.stopped.set()
+        self.wake.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.db.close()
+
+    def _run(self):
+        delay = self.interval
+        while not self.stopped.is_set():
+            self.wake.wait(delay)
+            self.wake.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.sync_once()
+                if time.monotonic() - self.last_pull > self.ttl and not self.pending():
+                    self.pull()
+                self.last_error = None
+                delay = self.interval
+            except Exception as e:
+                self.last_error = e
+                delay = min(delay * 2, MAX_SYNC_BACKOFF)
+
+    # Remove sent entries from the outbox. Rows edited again while being sent
+    # stay queued, as updates since they now exist on the remote, expecting
+    # the keys of the values sent from `data`.
+    def _settle(self, sent, data=None):
+        with self.lock:
+            keys = {} if data is None else dict(zip(data.index, self._keys(data)))
+            for row_id, op, version in sent:
+                self.db.execute("DELETE FROM outbox WHERE row_id = ? AND version = ?", (row_id, version))
+                self.db.execute("UPDATE outbox SET op = 'update', expected = COALESCE(?, expected) WHERE row_id = ?",
+                                (keys.get(row_id), row_id))
+            self.db.commit()
+
+    # Reload the remote after rows moved on it and move the queued changes to
+    # the rows their subjects are on now, to be sent on the next pass. A row
+    # whose subject is no longer found is appended again rather than lost.
+    def _rebase(self):
+        with self.lock:
+            version = self.version
+        data = self.backend.read()
+        with self.lock:
+            if self.version != version:
+                return  # Changed while reading; the next pass checks again
+            local = self.read()
+            entries = self.db.execute("SELECT row_id, op, version, expected FROM outbox ORDER BY row_id").fetchall()
+            remote_keys = pd.Series(self._keys(data), index=data.index, dtype=object)
+            merged = data.reindex(columns=local.columns)
+            next_label = int(data.index.max()) + 1 if len(data) else 0
+            queued = []
+            for row_id, op, entry_version, expected in entries:
+                if row_id not in local.index:
+                    continue
+                key = expected or self._keys(local.loc[[row_id]])[0]
+                matches = remote_keys.index[remote_keys == key] if op == 'update' else []
+                if len(matches):
+                    label = matches[0]
+                    remote_keys = remote_keys.drop(label)
+                else:
+                    label, op, expected = next_label, 'append', None
+                    next_label += 1
+                merged.loc[label] = local.loc[row_id]
+                queued.append((int(label), op, entry_version, expected))
+            self.db.execute("DELETE FROM outbox")
+            self.db.executemany("INSERT INTO outbox (row_id, op, version, expected) VALUES (?, ?, ?, ?)", queued)
+            self._write_table(merged.sort_index())
+            self.last_pull = time.monotonic()
+
+    # Move appended rows from the labels they were given locally to the
+    # positions the remote wrote them at, starting at `start`. The remote
+    # inserted them there, so the local rows at or below `start` move down.
+    def _relabel(self, row_ids, start):
+        with self.lock:
+            for table in ('records', 'outbox'):
+                # Through negative ids, as SQLite checks the primary key row by row
+                self.db.executemany(f"UPDATE {table} SET row_id = ? WHERE row_id = ?",
+                                    [(-(start + i) - 2, int(row_id)) for i, row_id in enumerate(row_ids)])
+                self.db.execute(f"UPDATE {table} SET row_id = -(row_id + ?) - 2 WHERE row_id >= ?",
+                                (len(row_ids), start))
+                self.db.execute(f"UPDATE {table} SET row_id = -row_id - 2 WHERE row_id < ?", (REPLACE_ALL,))
+            self.db.commit()
+            self.version += 1
+            self.frame = None
+
+    def _queue(self, row_ids, op, expected=None):
+        # An entry that is already queued keeps its op (an unsent append stays
+        # an append) and expected keys, and only has its version bumped
+        expected = expected or [None] * len(row_ids)
+        self.db.executemany(
+            "INSERT INTO outbox (row_id, op, version, expected) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT(row_id) DO UPDATE SET version = version + 1",
+            [(int(row_id), op, key) for row_id, key in zip(row_ids, expected)])
+        self.db.commit()
+        self.version += 1
+        self.frame = None
+
+    def _write_table(self, data):
+        if len(data.columns):
+            data.rename_axis('row_id').to_sql('records', self.db, if_exists='replace', index=True)
+        else:
+            # An empty worksheet has no schema; the first append creates it
+            self.db.execute("DROP TABLE IF EXISTS records")
+        self.db.commit()
+        self.frame = None
+        self.version += 1
+        if self.summary is not None:
+            self.summary.reset(data if len(data.columns) else pd.DataFrame())
+
+    def _has_records(self):
+        return self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'records'").fetchone() \
+            is not None
+
+    def _columns(self):
+        return [row[1] for row in self.db.execute("PRAGMA table_info(records)") if row[1] != 'row_id']
+
+    # Function to encode the key columns of each row for comparison, as the
+    # text the worksheet shows
+    def _keys(self, rows):
+        return [json.dumps([str(value) for value in values]) for values in sheet_values(rows, self.key_columns)]
+
+    @staticmethod
+    def _values(rows):
+        # SQLite only binds plain Python values
+        return rows.astype(object).where(rows.notna(), None).values.tolist()
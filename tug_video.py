@@ -0,0 +1,358 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+import perf
+
+# Bytes of decoded frames kept in memory per video, about 20 frames at 1080p
+FRAME_CACHE_BYTES = 128 * 1024 ** 2
+# Frames decoded ahead of the one being viewed, so "Next Frame" is a cache hit
+PREFETCH_FRAMES = 4
+# Longest side, in pixels, of the downscaled proxy frames used for scrubbing
+PROXY_MAX_SIDE = 480
+# Frame rate the default coarse navigation stride aims for, e.g. every 8th
+# frame of a 120 fps recording
+COARSE_FPS = 15
+# Seconds either side of a frame shown at full frame rate when refining
+REFINE_SECONDS = 0.5
+# Width, in pixels, of the grayscale frames used for motion analysis
+MOTION_WIDTH = 96
+# Frames differenced together in one vectorized batch
+MOTION_CHUNK = 256
+# Moving-average window, in seconds, applied to the motion energy
+MOTION_SMOOTHING_SECONDS = 0.5
+# Shortest stretch of motion, in seconds, treated as a TUG trial
+MIN_TRIAL_SECONDS = 2.0
+# Pauses shorter than this, in seconds, do not split a trial
+MIN_TRIAL_GAP_SECONDS = 1.0
+# Phase boundaries marked per trial, matching the "Average Phase Time" grouping
+PHASES_PER_TRIAL = 6
+
+
+# Lazy view over the frames of a video file. The capture stays open and frames
+# are decoded only when requested, so memory scales with the cache size rather
+# than with the length of the video.
+class VideoFrames:
+    def __init__(self, video_file, cache_bytes=FRAME_CACHE_BYTES):
+        # OpenCV is imported where it is first needed, so the app and batch
+        # workers start without loading it
+        import cv2
+
+        self.cap = cv2.VideoCapture(video_file)
+        self.cache = OrderedDict()
+        self.max_cache_bytes = cache_bytes
+        self.cache_bytes = 0  # Size of the frames in the cache
+        self.lock = threading.Lock()
+        self.next_index = 0  # Frame the capture returns on the next read()
+        self.released = False
+
+        if self.cap.isOpened():
+            self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        else:
+            self.frame_count = 0
+            self.fps = 0
+
+    def __len__(self):
+        return self.frame_count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.frame_count
+        if not 0 <= index < self.frame_count:
+            raise IndexError("frame index out of range")
+
+        with self.lock:
+            frame = self._get(index)
+        if frame is None:
+            raise IndexError(f"frame {index} could not be decoded")
+        return frame
+
+    def prefetch(self, index, count=PREFETCH_FRAMES):
+        # Read the frames following `index` sequentially into the cache
+        with self.lock:
+            for i in range(index + 1, min(index + 1 + count, self.frame_count)):
+                if i not in self.cache and self._get(i) is None:
+                    break
+
+    def release(self):
+        with self.lock:
+            self.cache.clear()
+            self.cache_bytes = 0
+            self.cap.release()
+            self.released = True
+
+    def _get(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            perf.count('frame_cache_hits')
+            return self.cache[index]
+
+        # A released capture reads nothing; that says nothing about the
+        # video's length, so it must not shrink frame_count
+        if self.released:
+            raise ValueError("video has been released")
+
+        # Only seek when the capture is not already positioned on the frame;
+        # stepping forward is a plain sequential read
+        if index != self.next_index:
+            import cv2
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            perf.count('frame_seeks')
+        ret, frame = self.cap.read()
+        if not ret:
+            # The container over-reported its length; shrink to what decodes
+            self.frame_count = min(self.frame_count, index)
+            self.next_index = -1
+            return None
+        self.next_index = index + 1
+        perf.count('frames_decoded')
+
+        self.cache[index] = frame
+        self.cache_bytes += frame.nbytes
+        while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 1:
+            self.cache_bytes -= self.cache.popitem(last=False)[1].nbytes
+        return frame
+
+
+# Function to open the video for lazy frame access
+@perf.timed('video.open')
+def get_video_frames(video_file):
+    frames = VideoFrames(video_file)
+    timestamps = []
+
+    if not frames:
+        return frames, timestamps  # Return an empty provider if the video cannot be opened
+
+    # Keep the fractional frame rate (e.g. 29.97 or 239.76) so timestamps do
+    # not drift; container timestamps replace these once the video is indexed
+    fps = frames.fps
+    timestamps = [i / fps for i in range(len(frames))]  # timestamp in seconds
+
+    return frames, timestamps
+
+
+# Function to decode the video once into a downscaled proxy for scrubbing. The
+# frames are written to a memory-mapped .npy file so only the slices being
+# displayed are paged into memory.
+@perf.timed('video.proxy')
+def build_proxy(video_file, proxy_path, max_side=PROXY_MAX_SIDE, grayscale=False):
+    import cv2
+
+    cap = cv2.VideoCapture(video_file)
+    if not cap.isOpened():
+        return None
+
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    scale = min(1.0, max_side / max(width, height, 1))
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    shape = (frame_count, size[1], size[0]) if grayscale else (frame_count, size[1], size[0], 3)
+
+    # Write under a temporary name so a half-built proxy is never picked up
+    tmp_path = f"{proxy_path}.{threading.get_ident()}.tmp.npy"
+    proxy = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+    decoded = 0
+    for i in range(frame_count):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if scale < 1.0:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if grayscale:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        proxy[i] = frame
+        decoded += 1
+    cap.release()
+    perf.count('frames_decoded', decoded)
+    proxy.flush()
+    del proxy
+    os.replace(tmp_path, proxy_path)
+
+    # The container may over-report its length; only expose decoded frames
+    return np.load(proxy_path, mmap_mode='r')[:decoded]
+
+
+# Function to index the video for coarse navigation in one sequential pass.
+# Every frame is only grabbed, which skips the colour conversion and copy, and
+# its container timestamp recorded; every `stride`-th frame is also retrieved
+# and downscaled straight away into a memory-mapped .npy file. Returns the
+# downscaled frames and the timestamps, in seconds, of all frames.
+@perf.timed('video.coarse')
+def build_coarse_index(video_file, index_path, stride, max_side=PROXY_MAX_SIDE):
+    import cv2
+
+    cap = cv2.VideoCapture(video_file)
+    if not cap.isOpened():
+        return None, []
+
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    scale = min(1.0, max_side / max(width, height, 1))
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    tmp_path = f"{index_path}.{threading.get_ident()}.tmp.npy"
+    thumbnails = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                           shape=(-(-frame_count // stride), size[1], size[0], 3))
+    timestamps = []
+    kept = 0
+    while len(timestamps) < frame_count and cap.grab():
+        i = len(timestamps)
+        timestamps.append(cap.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+        if i % stride == 0:
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            thumbnails[kept] = cv2.resize(frame, size, interpolation=cv2.INTER_AREA) if scale < 1.0 else frame
+            kept += 1
+    cap.release()
+    perf.count('frames_decoded', kept)
+    thumbnails.flush()
+    del thumbnails
+    os.replace(tmp_path, index_path)
+
+    # Containers without usable timestamps fall back to the frame rate
+    if fps and (not any(timestamps) or any(b < a for a, b in zip(timestamps, timestamps[1:]))):
+        timestamps = [i / fps for i in range(len(timestamps))]
+    return np.load(index_path, mmap_mode='r')[:kept], timestamps
+
+
+# Function to return the (first, last) frame shown at full frame rate when
+# refining around `index`
+def refine_window(index, fps, frame_count, seconds=REFINE_SECONDS):
+    half = max(1, round(seconds * fps))
+    return max(0, index - half), min(frame_count - 1, index + half)
+
+
+# Generator of downscaled grayscale frames, decoded in a single sequential pass
+# and stacked into batches for vectorized differencing
+def small_gray_chunks(video_file, width=MOTION_WIDTH, chunk=MOTION_CHUNK):
+    import cv2
+
+    cap = cv2.VideoCapture(video_file)
+    batch = []
+    size = None
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if size is None:
+            height = frame.shape[0] * width // frame.shape[1]
+            size = (width, max(1, height))
+        batch.append(cv2.cvtColor(cv2.resize(frame, size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY))
+        if len(batch) == chunk:
+            yield np.stack(batch)
+            batch = []
+    cap.release()
+    if batch:
+        yield np.stack(batch)
+
+
+# Same batches read from an existing proxy, without decoding the video again
+def proxy_chunks(proxy, width=MOTION_WIDTH, chunk=MOTION_CHUNK):
+    step = max(1, proxy.shape[2] // width)
+    for start in range(0, len(proxy), chunk):
+        block = proxy[start:start + chunk, ::step, ::step]
+        if block.ndim == 4:
+            block = block.mean(axis=3)
+        yield block
+
+
+# Function to compute per-frame motion energy: the mean absolute difference
+# between each frame and the one before it (zero for the first frame)
+def motion_energy(chunks):
+    energy = []
+    previous = None
+    for block in chunks:
+        block = block.astype(np.float32)
+        if previous is None:
+            energy.append(np.zeros(1, dtype=np.float32))
+            stacked = block
+        else:
+            stacked = np.concatenate((previous[None], block))
+        energy.append(np.abs(np.diff(stacked, axis=0)).mean(axis=(1, 2)))
+        previous = block[-1]
+
+    if not energy:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(energy)
+
+
+def smooth_signal(signal, window):
+    if window <= 1 or len(signal) < window:
+        return signal
+    return np.convolve(signal, np.ones(window) / window, mode='same')
+
+
+# Function to split a trial into phases at the deepest dips in motion, falling
+# back to equal shares of the trial's motion when there are too few dips
+def trial_boundaries(smoothed, start, end, phases=PHASES_PER_TRIAL):
+    segment = smoothed[start:end + 1]
+    interior = phases - 2
+    min_spacing = max(1, len(segment) // (2 * phases))
+
+    minima = np.flatnonzero((segment[1:-1] < segment[:-2]) & (segment[1:-1] <= segment[2:])) + 1
+    picked = []
+    for i in minima[np.argsort(segment[minima], kind='stable')]:
+        if min(i, len(segment) - 1 - i) < min_spacing:
+            continue
+        if all(abs(i - j) >= min_spacing for j in picked):
+            picked.append(i)
+        if len(picked) == interior:
+            break
+
+    if len(picked) < interior:
+        cumulative = np.cumsum(segment)
+        targets = cumulative[-1] * np.arange(1, interior + 1) / (interior + 1)
+        picked = np.searchsorted(cumulative, targets)
+
+    return [int(start)] + sorted(int(start + i) for i in picked) + [int(end)]
+
+
+# Function to propose phase-boundary frames from the motion energy: each
+# sustained stretch of motion is taken as one trial
+def detect_phase_candidates(energy, fps, phases=PHASES_PER_TRIAL):
+    if len(energy) == 0 or fps <= 0:
+        return []
+
+    smoothed = smooth_signal(energy, int(round(fps * MOTION_SMOOTHING_SECONDS)))
+    floor = np.percentile(smoothed, 10)
+    peak = np.percentile(smoothed, 95)
+    if peak <= floor:
+        return []
+    active = smoothed > floor + 0.25 * (peak - floor)
+
+    # Rising and falling edges of the active mask delimit stretches of motion
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], active.astype(np.int8), [0]))))
+    segments = []
+    for start, stop in zip(edges[::2], edges[1::2]):
+        if segments and start - segments[-1][1] < fps * MIN_TRIAL_GAP_SECONDS:
+            segments[-1][1] = stop
+        else:
+            segments.append([start, stop])
+
+    candidates = []
+    for start, stop in segments:
+        if stop - start >= fps * MIN_TRIAL_SECONDS:
+            candidates.extend(trial_boundaries(smoothed, start, stop - 1, phases))
+    return candidates
+
+
+# Function to average the selected timestamps phase by phase. Selections are
+# grouped by the pattern 1, 7, 13; 2, 8, 14, and so on (every 6th element
+# starting from each phase).
+def phase_averages(timestamps, phases=PHASES_PER_TRIAL):
+    df = pd.DataFrame({'timestamps': timestamps}, dtype=float)
+
+    averages = []
+    for i in range(phases):
+        group = df['timestamps'].iloc[i::phases]
+        avg = round(group.mean(), 2)  # Calculate the average of the group
+        averages.append(float(avg))
+    return averages